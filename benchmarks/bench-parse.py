@@ -0,0 +1,65 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Compare the fast JSON extraction in pvldb-collect.py against the old
+# BeautifulSoup path on the saved volume pages in benchmarks/fixtures.
+#
+#   python ./benchmarks/bench-parse.py [--repeat N]
+#
+
+import os
+import sys
+import glob
+import time
+import argparse
+import tracemalloc
+import importlib.util
+
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+FIXTURES_DIR = os.path.join(BASE_DIR, "benchmarks", "fixtures")
+
+def loadScript(name):
+    # The entry points have dashes in their names so we can't just import them
+    sys.path.insert(0, BASE_DIR)
+    spec = importlib.util.spec_from_file_location(name.replace("-", "_"), os.path.join(BASE_DIR, name + ".py"))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+## DEF
+
+def measure(func, html, repeat):
+    best = None
+    for i in range(repeat):
+        start = time.perf_counter()
+        func(html)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    ## FOR
+    tracemalloc.start()
+    func(html)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return (best, peak)
+## DEF
+
+if __name__ == '__main__':
+    aparser = argparse.ArgumentParser(description='PVLDB Volume Page Parsing Benchmark')
+    aparser.add_argument('--repeat', type=int, default=10, help='Number of times to parse each fixture')
+    args = vars(aparser.parse_args())
+
+    collect = loadScript("pvldb-collect")
+
+    print("%-28s %10s %12s %10s %12s %8s" % ("FIXTURE", "SOUP (ms)", "SOUP (KB)", "FAST (ms)", "FAST (KB)", "SPEEDUP"))
+    for path in sorted(glob.glob(os.path.join(FIXTURES_DIR, "*-volume-info.html"))):
+        with open(path, "rb") as fd:
+            html = fd.read()
+        assert collect.extractJson(html) == collect.extractJsonSoup(html), "Mismatched JSON for " + path
+
+        soup_time, soup_mem = measure(collect.extractJsonSoup, html, args["repeat"])
+        fast_time, fast_mem = measure(collect.extractJson, html, args["repeat"])
+        print("%-28s %10.2f %12.1f %10.2f %12.1f %7.1fx" % (os.path.basename(path),
+                                                          soup_time * 1000, soup_mem / 1024,
+                                                          fast_time * 1000, fast_mem / 1024,
+                                                          soup_time / fast_time))
+    ## FOR
+## MAIN
@@ -0,0 +1,415 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Time the hot paths of the collector, the feed generator, and the thumbnails
+# against the fixtures in benchmarks/fixtures and a synthetic database, and
+# compare them to the numbers in benchmarks/baseline.json. Nothing here
+# touches the network. Exits with an error if a stage got slower or bigger
+# than the baseline by more than the tolerance.
+#
+#   python ./benchmarks/bench-suite.py [--repeat N] [--stage NAME ...]
+#   python ./benchmarks/bench-suite.py --save-baseline
+#
+# Every stage runs in its own process so that its peak RSS is not mixed
+# up with the other stages. The baseline is only meaningful on the machine
+# where it was recorded, so save a new one before comparing on another box.
+# The render stage needs pdftoppm (poppler) and is skipped without it. A
+# stage that is in the baseline but got skipped counts as a failure, so
+# record the render stage with --save-baseline --stage render on a machine
+# that has poppler.
+#
+
+import os
+import sys
+import json
+import glob
+import time
+import random
+import shutil
+import logging
+import argparse
+import resource
+import tempfile
+import subprocess
+import importlib.util
+from datetime import datetime, timedelta, timezone
+
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+FIXTURES_DIR = os.path.join(BASE_DIR, "benchmarks", "fixtures")
+BASELINE_FILE = os.path.join(BASE_DIR, "benchmarks", "baseline.json")
+sys.path.insert(0, BASE_DIR)
+
+SAMPLE_PDF = os.path.join(FIXTURES_DIR, "sample-paper.pdf")
+SAMPLE_PDF_URL = "https://www.vldb.org/pvldb/vol99/p1-sample.pdf"
+
+# Parsing one page only takes milliseconds, so time a few rounds of them
+PARSE_ROUNDS = 20
+
+# The sizes in KB that the synthetic page image gets squeezed into. The first one
+# only needs the quality search, the second one also has to scale it down.
+ENCODE_LIMITS = [ 256, 64 ]
+
+# Used to make up the synthetic papers. The seed is fixed so that every run
+# (and every machine) gets the exact same database.
+SYNTHETIC_SEED = 15
+SYNTHETIC_NUMBERS = 12
+SYNTHETIC_PER_NUMBER = 100
+WORDS = ("Efficient Scalable Adaptive Learned Distributed Transactional Incremental Approximate Query "
+         "Processing Index Graph Stream Join Optimization Storage Engine Vector Search Cardinality Estimation "
+         "Columnar Compression Replication Consensus Serverless Cloud Lakes Benchmarking Workload Tuning "
+         "Caching Provenance Cleaning Integration Time-Series Spatial Embeddings Federated Privacy-Preserving").split()
+FIRST_NAMES = ("Alice Bo Chen Dana Elif Farid Gita Hiro Inés Jun Kai Lena Mateo Nia Omar Priya Qiu Rosa "
+               "Sven Tara Uma Viktor Wen Yara Zoë").split()
+LAST_NAMES = ("Anders Bauer Castro Dubois Evans Fischer García Huang Ito Jensen Kim Li Moreno Nakamura Olsen "
+              "Patel Rossi Schmidt Tanaka Umar Varga Wang Xu Yılmaz Zhang").split()
+
+def loadScript(name):
+    # The entry points have dashes in their names so we can't just import them
+    spec = importlib.util.spec_from_file_location(name.replace("-", "_"), os.path.join(BASE_DIR, name + ".py"))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+## DEF
+
+def getPeakRss():
+    """Peak resident set size of this process in MB (ru_maxrss is KB on Linux, bytes on macOS)"""
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == "darwin":
+        peak //= 1024
+    return peak / 1024
+## DEF
+
+## ==============================================
+## Synthetic Data
+## ==============================================
+def makePapers(num_papers, seed=SYNTHETIC_SEED):
+    """
+    Make up papers in the same (volume, number) -> papers format that
+    getPapers() in pvldb-collect.py returns.
+    """
+    rand = random.Random(seed)
+    published = datetime(2024, 1, 1, tzinfo=timezone.utc)
+    papers = { }
+    for i in range(num_papers):
+        volume = 1 + i // (SYNTHETIC_NUMBERS * SYNTHETIC_PER_NUMBER)
+        number = 1 + (i // SYNTHETIC_PER_NUMBER) % SYNTHETIC_NUMBERS
+        authors = [ "%s %s" % (rand.choice(FIRST_NAMES), rand.choice(LAST_NAMES)) for j in range(rand.randint(1, 9)) ]
+        papers.setdefault((volume, number), []).append({
+            "authors":      ", ".join(authors),
+            "title":        " ".join(rand.choice(WORDS) for j in range(rand.randint(5, 11))),
+            "volume":       volume,
+            "number":       number,
+            "link":         "https://www.vldb.org/pvldb/vol%d/p%d-%s.pdf" % (volume, i, rand.choice(LAST_NAMES).lower()),
+            "published":    published + timedelta(days=volume * 30 + number),
+        })
+    ## FOR
+    return papers
+## DEF
+
+def makePageImage(path, width, quality, seed=SYNTHETIC_SEED):
+    """
+    Draw something that looks like the first page of a paper (a figure across
+    the top and two columns of text) and save it as a JPEG like getImage()
+    would. This does not need pdftoppm, and the same seed and Pillow version
+    always give the exact same file.
+    """
+    from PIL import Image, ImageDraw
+    rand = random.Random(seed)
+    height = width * 22 // 17 # US Letter
+    margin = width // 12
+    image = Image.new("RGB", (width, height), "white")
+    draw = ImageDraw.Draw(image)
+
+    # The figure is blown-up noise so that it neither compresses away to
+    # nothing nor dominates the size of the file like pure noise would
+    figure = (width - 2 * margin, height // 4)
+    noise = (figure[0] // 8, figure[1] // 8)
+    image.paste(Image.frombytes("RGB", noise, rand.randbytes(noise[0] * noise[1] * 3)).resize(figure, Image.BICUBIC), (margin, margin))
+
+    column = (width - 3 * margin) // 2
+    for left in (margin, 2 * margin + column):
+        for top in range(2 * margin + figure[1], height - margin, 36):
+            line = ""
+            while draw.textlength(line) < column - 60:
+                line += rand.choice(WORDS) + " "
+            draw.text((left, top), line.strip(), fill="black")
+        ## FOR
+    ## FOR
+    image.save(path, format="JPEG", quality=quality, optimize=True)
+## DEF
+
+def makeDatabase(path, num_papers):
+    """Create the synthetic database with the collector's own insert path"""
+    collect = loadScript("pvldb-collect")
+    from database import openDatabase, closeDatabase
+    if os.path.exists(path):
+        os.remove(path)
+    db = openDatabase(path, create=True)
+    collect.insertPapers(db, makePapers(num_papers))
+    db.commit()
+    closeDatabase(db)
+## DEF
+
+## ==============================================
+## Stages
+## ==============================================
+# Each stage does its setup, runs the code that we care about 'repeat'
+# times, and returns the best wall time in seconds. Anything that has to
+# be reset between runs happens outside of the timed part.
+
+def benchParse(args, workdir):
+    """Parse the saved volume pages with pvldb-collect.py's getPapers()"""
+    collect = loadScript("pvldb-collect")
+    pages = { }
+    for path in sorted(glob.glob(os.path.join(FIXTURES_DIR, "vol*-volume-info.html"))):
+        volume = int(os.path.basename(path).split("-")[0][3:])
+        with open(path, "rb") as fd:
+            pages[collect.START_URL % volume] = (volume, fd.read())
+    ## FOR
+    assert pages, "No volume pages in " + FIXTURES_DIR
+    collect.fetchUrl = lambda url, cache=None: pages[url][1]
+
+    best = None
+    for i in range(args["repeat"]):
+        start = time.perf_counter()
+        for j in range(PARSE_ROUNDS):
+            for url, (volume, html) in pages.items():
+                assert collect.getPapers(volume, url)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    ## FOR
+    return best
+## DEF
+
+def benchUpsert(args, workdir):
+    """Insert the synthetic papers into an empty database and then again into the full one"""
+    collect = loadScript("pvldb-collect")
+    from database import openDatabase, closeDatabase
+    papers = makePapers(args["papers"])
+    path = os.path.join(workdir, "upsert.db")
+
+    best = None
+    for i in range(args["repeat"]):
+        for suffix in ("", "-wal", "-shm"):
+            if os.path.exists(path + suffix):
+                os.remove(path + suffix)
+        db = openDatabase(path, create=True)
+        start = time.perf_counter()
+        num_new = collect.insertPapers(db, papers)
+        db.commit()
+        # The second time around every paper is already there
+        collect.insertPapers(db, papers)
+        db.commit()
+        elapsed = time.perf_counter() - start
+        closeDatabase(db)
+        assert num_new == args["papers"], "Inserted %d of %d papers" % (num_new, args["papers"])
+        best = elapsed if best is None else min(best, elapsed)
+    ## FOR
+    return best
+## DEF
+
+def benchFeed(args, workdir, backend):
+    """Rebuild the main feeds and all of the archive pages from scratch"""
+    rss = loadScript("pvldb-rss")
+    from database import openDatabase, closeDatabase
+    db = openDatabase(os.path.join(workdir, "papers.db"))
+    writer = rss.FEED_WRITERS[backend]
+    num_pages = args["papers"] // rss.FEED_ARCHIVE_SIZE
+    window = max(rss.FEED_WINDOW, args["papers"] - num_pages * rss.FEED_ARCHIVE_SIZE)
+
+    best = None
+    for i in range(args["repeat"]):
+        output = os.path.join(workdir, "feed-" + backend)
+        shutil.rmtree(output, ignore_errors=True)
+        os.makedirs(output)
+        start = time.perf_counter()
+        rss.writeArchives(db, output, writer, { }, num_pages, rss.FEED_ARCHIVE_SIZE, force=True)
+        writer(db, rss.getWindowQuery(window), output, num_pages=num_pages)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    ## FOR
+    closeDatabase(db)
+    return best
+## DEF
+
+def setupThumbnails(workdir):
+    """
+    Point the thumbnails module at a cache in the workdir that already holds the
+    sample PDF, like getPdf() would have left it after downloading it. Returns
+    the module, or None if pdftoppm is not installed and we cannot render.
+    """
+    if shutil.which("pdftoppm") is None:
+        return None
+    import thumbnails
+    thumbnails.CACHE_DIR = os.path.join(workdir, "cache")
+    def noDownload(url, path, *args, **kwargs):
+        raise Exception("The benchmarks must not download '%s'" % url)
+    thumbnails.downloadFile = noDownload
+
+    digest = thumbnails.hashFile(SAMPLE_PDF)
+    shutil.copyfile(SAMPLE_PDF, thumbnails.getCachePath("pdf", digest + ".pdf"))
+    with open(thumbnails.getUrlPath(SAMPLE_PDF_URL), "w") as fd:
+        json.dump({"url": SAMPLE_PDF_URL, "sha256": digest, "size": os.path.getsize(SAMPLE_PDF)}, fd)
+    return thumbnails
+## DEF
+
+def benchRender(args, workdir):
+    """Render the first page of the sample PDF with getImage() from a pre-filled cache"""
+    thumbnails = setupThumbnails(workdir)
+    if thumbnails is None:
+        return None
+    best = None
+    for i in range(args["repeat"]):
+        shutil.rmtree(thumbnails.getCachePath("thumbs", ""), ignore_errors=True)
+        start = time.perf_counter()
+        thumbnails.getImage(SAMPLE_PDF_URL)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    ## FOR
+    return best
+## DEF
+
+def benchEncode(args, workdir):
+    """Squeeze a synthetic first page below each of the ENCODE_LIMITS with resizeImage()"""
+    import thumbnails
+    img_path = os.path.join(workdir, "page.jpg")
+    makePageImage(img_path, thumbnails.THUMBNAIL_WIDTH, thumbnails.THUMBNAIL_QUALITY)
+    best = None
+    for i in range(args["repeat"]):
+        start = time.perf_counter()
+        for max_size_kb in ENCODE_LIMITS:
+            assert len(thumbnails.resizeImage(img_path, max_size_kb)) <= max_size_kb * 1024
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    ## FOR
+    return best
+## DEF
+
+STAGES = {
+    "parse":        benchParse,
+    "upsert":       benchUpsert,
+    "feed-feedgen": lambda args, workdir: benchFeed(args, workdir, "feedgen"),
+    "feed-stream":  lambda args, workdir: benchFeed(args, workdir, "stream"),
+    "render":       benchRender,
+    "encode":       benchEncode,
+}
+
+## ==============================================
+## runStage
+## ==============================================
+def runStage(args, workdir, stage):
+    """
+    Run the stage in a new copy of this script and return its wall time and peak RSS.
+    Linux carries ru_maxrss over through fork() and exec(), so this process has to
+    stay small or every stage would report at least our own peak.
+    """
+    cmd = [ sys.executable, os.path.realpath(__file__), "--child", stage, "--workdir", workdir,
+            "--repeat", str(args["repeat"]), "--papers", str(args["papers"]) ]
+    output = subprocess.run(cmd, check=True, stdout=subprocess.PIPE).stdout
+    return json.loads(output) if output else None
+## DEF
+
+def compare(result, baseline, tolerance):
+    """Return the relative change against the baseline and whether it is beyond the tolerance"""
+    if result is None or not baseline:
+        return (None, False)
+    change = result / baseline - 1.0
+    return (change, change > tolerance)
+## DEF
+
+def formatChange(change, regressed):
+    if change is None:
+        return "-"
+    return "%+.0f%%%s" % (change * 100, " !!" if regressed else "")
+## DEF
+
+## ==============================================
+## main
+## ==============================================
+if __name__ == '__main__':
+    aparser = argparse.ArgumentParser(description='PVLDB Offline Benchmark Suite')
+    aparser.add_argument('--stage', action='append', choices=STAGES.keys(), help='Only run this stage (can be given more than once)')
+    aparser.add_argument('--repeat', type=int, default=3, help='Number of times to run each stage (the best time is kept)')
+    aparser.add_argument('--papers', type=int, default=50000, help='Number of papers in the synthetic database')
+    aparser.add_argument('--tolerance', type=float, default=0.25, help='Allowed slowdown or growth against the baseline (0.25 = 25%%)')
+    aparser.add_argument('--baseline', default=BASELINE_FILE, help='Baseline file to compare against')
+    aparser.add_argument('--save-baseline', action='store_true', help='Store the results as the new baseline')
+    aparser.add_argument('--child', help=argparse.SUPPRESS)
+    aparser.add_argument('--workdir', help=argparse.SUPPRESS)
+    args = vars(aparser.parse_args())
+
+    # The scripts log every schema migration and feed that they write
+    logging.disable(logging.WARNING)
+    if args["child"] == "setup":
+        makeDatabase(os.path.join(args["workdir"], "papers.db"), args["papers"])
+        sys.exit(0)
+    elif args["child"]:
+        elapsed = STAGES[args["child"]](args, args["workdir"])
+        print(json.dumps({ "wall": elapsed, "rss": getPeakRss() if elapsed is not None else None }))
+        sys.exit(0)
+
+    ## ----------------------------------------------
+
+    baseline = { }
+    if not args["save_baseline"] and os.path.exists(args["baseline"]):
+        with open(args["baseline"], "r") as fd:
+            baseline = json.load(fd)
+        if baseline.get("papers") != args["papers"]:
+            print("Ignoring the baseline because it was recorded with %s papers" % baseline.get("papers"))
+            baseline = { }
+
+    stages = args["stage"] or list(STAGES.keys())
+    results = { }
+    regressions = [ ]
+    skipped = [ ]
+    workdir = tempfile.mkdtemp(prefix="pvldb-bench-")
+    try:
+        runStage(args, workdir, "setup")
+
+        print("%-14s %10s %10s %9s %10s %10s %9s" % ("STAGE", "WALL (s)", "BASE (s)", "CHANGE", "RSS (MB)", "BASE (MB)", "CHANGE"))
+        for stage in stages:
+            result = runStage(args, workdir, stage)
+            results[stage] = result
+            base = baseline.get("stages", { }).get(stage, { })
+            if result["wall"] is None:
+                print("%-14s %10s" % (stage, "skipped"))
+                if base:
+                    skipped.append(stage)
+                continue
+            wall_change, wall_regressed = compare(result["wall"], base.get("wall"), args["tolerance"])
+            rss_change, rss_regressed = compare(result["rss"], base.get("rss"), args["tolerance"])
+            if wall_regressed or rss_regressed:
+                regressions.append(stage)
+            print("%-14s %10.3f %10s %9s %10.1f %10s %9s" % (stage,
+                  result["wall"], "%.3f" % base["wall"] if base.get("wall") else "-", formatChange(wall_change, wall_regressed),
+                  result["rss"], "%.1f" % base["rss"] if base.get("rss") else "-", formatChange(rss_change, rss_regressed)))
+        ## FOR
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    if args["save_baseline"]:
+        # Keep the stages that were not run this time
+        if os.path.exists(args["baseline"]):
+            with open(args["baseline"], "r") as fd:
+                baseline = json.load(fd)
+        if baseline.get("papers") != args["papers"]:
+            baseline = { "stages": { } }
+        baseline["papers"] = args["papers"]
+        for stage, result in results.items():
+            if result["wall"] is not None:
+                baseline["stages"][stage] = result
+        with open(args["baseline"], "w") as fd:
+            json.dump(baseline, fd, indent=2, sort_keys=True)
+            fd.write("\n")
+        print("Saved the baseline to " + args["baseline"])
+    else:
+        missing = [ stage for stage in stages if results[stage]["wall"] is not None and stage not in baseline.get("stages", { }) ]
+        if baseline and missing:
+            print("No baseline for: %s" % ", ".join(missing))
+        if skipped:
+            print("Skipped but in the baseline: %s" % ", ".join(skipped))
+        if regressions:
+            print("Regressed by more than %d%%: %s" % (args["tolerance"] * 100, ", ".join(regressions)))
+        if skipped or regressions:
+            sys.exit(1)
+## MAIN
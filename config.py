@@ -1,5 +1,6 @@
 import os
 import sys
+import tempfile
 from enum import Enum
 
 ## ==============================================
@@ -11,19 +12,112 @@ RSS_AUTHOR = {'name':'Andy Pavlo','email':'pavlo@cs.cmu.edu'}
 RSS_SUBTITLE = 'Digest for PVLDB papers generated by the Carnegie Mellon Database Group'
 RSS_FILE = "pvldb-rss.xml"
 RSS_URL = "https://db.cs.cmu.edu/files/" + RSS_FILE
+# Where the feed files are actually served from (see README.md)
+FEED_BASE_URL = "https://db.cs.cmu.edu/files/rss/"
+ATOM_FILE = "pvldb-atom.xml"
+FEED_STATE_FILE = ".pvldb-feed.json"
+
+# The main feeds only contain the most recent papers. Everything older is
+# in fixed-size archive pages that are linked together (RFC 5005)
+FEED_WINDOW = 100
+FEED_ARCHIVE_SIZE = 500
+
+# How pvldb-rss.py builds the feeds ("feedgen" or "stream")
+FEED_BACKEND = "feedgen"
+
+# Write precompressed .gz/.br copies of the feeds next to them
+FEED_COMPRESS = False
 
 START_URL = "https://vldb.org/pvldb/vol%d-volume-info/"
 BASE_URL = "https://www.vldb.org"
 #BASE_URL = os.path.join(HOMEPAGE_URL, "/pvldb/")
 
+COLLECT_JOBS = 4
+COLLECT_MAX_PER_HOST = 4 # concurrent requests per host
+COLLECT_TIMEOUT = 60 # seconds
+# PVLDB starts about one volume a year, so '--collect-auto' never probes more
+# than this many past the high-water mark. This keeps a server that answers
+# unknown volumes with a 200 from sending us off probing forever.
+COLLECT_MAX_NEW_VOLUMES = 2
+
 # DB_PATH = os.path.join(os.path.dirname(os.path.realpath(__file__)), "pvldb.db")
+DB_BUSY_TIMEOUT = 60 # seconds to wait for another script's write lock
+DB_CACHE_SIZE = 16 * 1024 # KB
+DB_MMAP_SIZE = 64 * 1024 * 1024 # bytes
+DB_STATEMENT_CACHE = 256 # prepared statements per connection
+DB_COMMIT_BATCH = 100 # changes
+DB_COMMIT_INTERVAL = 5 # seconds
 
 POST_SLEEP_TIME = 1200 # seconds
+SCHEDULE_POLL_TIME = 600 # seconds
 POST_MAX_NUM_CHARS = {
     "twitter": 250,
     "mastodon": 500,
     "bluesky": 300,
 }
+POST_TIMEOUT = {
+    "twitter": 180, # seconds
+    "mastodon": 180,
+    "bluesky": 180,
+}
+# Timeout for each HTTP request that the API clients send. A post takes up to
+# three requests (e.g., media upload, caption, status), so this has to stay well
+# below POST_TIMEOUT. Otherwise a request that we already gave up on could
+# still go through and the paper would get posted twice.
+POST_REQUEST_TIMEOUT = {
+    "twitter": 45, # seconds
+    "mastodon": 45,
+    "bluesky": 45,
+}
+
+# Token bucket for each target: (number of posts, seconds)
+# These get adjusted by the rate-limit headers that the APIs send back
+POST_RATE_LIMITS = {
+    "twitter": (17, 86400),
+    "mastodon": (300, 10800),
+    "bluesky": (1600, 3600),
+}
+POST_RATE_RETRIES = 3
+POST_RATE_BACKOFF = 60 # seconds
+
+# Posts that fail are retried with jittered exponential backoff starting at
+# POST_RETRY_DELAY. After POST_MAX_ATTEMPTS failures they are marked as FAILED.
+POST_MAX_ATTEMPTS = 5
+POST_RETRY_DELAY = 300 # seconds
+POST_RETRY_MAX_DELAY = 6 * 3600 # seconds
+
+# Thumbnail of the first page for each target: (max width in pixels, max file size in KB)
+POST_IMAGE_LIMITS = {
+    "twitter": (1200, 5120),
+    "mastodon": (1200, 8192),
+    "bluesky": (1000, 950),
+}
+THUMBNAIL_WIDTH = 1200 # pixels
+THUMBNAIL_QUALITY = 85
+THUMBNAIL_MIN_QUALITY = 60
+THUMBNAIL_SCALE_STEPS = 7
+
+PREFETCH_COUNT = 3 # papers
+PREFETCH_JOBS = 2
+
+CACHE_DIR = os.path.join(tempfile.gettempdir(), "pvldb-cache")
+CACHE_MAX_SIZE = 512 * 1024 * 1024 # bytes
+# Files that were used this recently are never evicted because another
+# process (e.g., a prefetch thread or pvldb-thumbs worker) may be rendering them
+CACHE_MIN_AGE = 15 * 60 # seconds
+
+DOWNLOAD_TIMEOUT = (10, 60) # (connect, read) seconds
+DOWNLOAD_RETRIES = 3
+DOWNLOAD_MAX_SIZE = 100 * 1024 * 1024 # bytes
+DOWNLOAD_CHUNK_SIZE = 64 * 1024 # bytes
+DOWNLOAD_POOL_SIZE = 8
+
+# Where the scripts write their timers and counters at exit (see metrics.py).
+# Files that end in '.prom' are for node_exporter's textfile collector,
+# anything else gets a JSON summary. None turns it off.
+METRICS_FILE = None
+METRICS_PREFIX = "pvldb_"
+METRICS_BUCKETS = [ 0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300 ] # seconds
 
 SKIP = set([ "vol%d.html" % x for x in range(1, 5) ])
 
@@ -32,3 +126,4 @@ class PostStatus(Enum):
     FAILED = -1
     PENDING = 0
     SUCCESS = 1
+    UNKNOWN = 2 # Timed out, so we do not know whether it got posted
@@ -0,0 +1,383 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import os
+import time
+import logging
+import sqlite3
+
+from config import *
+
+## ==============================================
+## LOGGING
+## ==============================================
+LOG = logging.getLogger(__name__)
+LOG_handler = logging.StreamHandler()
+LOG_formatter = logging.Formatter(fmt='%(asctime)s [%(funcName)s:%(lineno)03d] %(levelname)-5s: %(message)s',
+                                  datefmt='%m-%d-%Y %H:%M:%S')
+LOG_handler.setFormatter(LOG_formatter)
+LOG.addHandler(LOG_handler)
+LOG.setLevel(logging.INFO)
+
+POST_TARGETS = [ "twitter", "mastodon", "bluesky" ]
+
+# The WHERE clause of the partial index for the papers that still need to
+# be posted. SQLite only uses a partial index when the query contains its
+# WHERE clause word for word, so use getPendingWhere() to build the queries.
+PENDING_WHERE = " OR ".join("%s = %d" % (t, PostStatus.PENDING.value) for t in POST_TARGETS)
+
+## ==============================================
+## Migrations
+## ==============================================
+# Each migration is applied once, in order, and then recorded in the
+# database's 'PRAGMA user_version'. Never change a migration that has
+# already been released. Add a new one to the end of the list instead.
+# A migration is either a list of SQL statements or a function that
+# takes the database connection.
+
+def addPostTargetColumns(db):
+    """Add the status columns for the post targets that older databases do not have"""
+    cur = db.cursor()
+    columns = [ row[1] for row in cur.execute("PRAGMA table_info(papers)") ]
+    for target in POST_TARGETS:
+        if target not in columns:
+            LOG.info("Adding '%s' column to papers table", target)
+            cur.execute("ALTER TABLE papers ADD COLUMN %s INT NOT NULL DEFAULT %d" % (target, PostStatus.PENDING.value))
+    ## FOR
+## DEF
+
+def addAllPaperAuthors(db):
+    """Fill in the normalized authors for the papers that are already in the database"""
+    rows = db.execute("SELECT link, authors FROM papers").fetchall()
+    addPaperAuthors(db, rows)
+    LOG.info("Added the authors for %d papers", len(rows))
+## DEF
+
+MIGRATIONS = [
+    # 1: The original papers table
+    [
+        """CREATE TABLE IF NOT EXISTS papers (
+            link VARCHAR(255) PRIMARY KEY,
+            title TEXT NOT NULL,
+            authors TEXT NOT NULL,
+            volume INT NOT NULL,
+            number INT NOT NULL,
+            published DATE NOT NULL,
+            twitter INT NOT NULL DEFAULT 0,
+            mastodon INT NOT NULL DEFAULT 0,
+            created timestamp DEFAULT CURRENT_TIMESTAMP
+        )""",
+    ],
+    # 2: Bluesky support
+    addPostTargetColumns,
+    # 3: The tables that the collector, poster, and thumbnail scripts used to create on their own
+    [
+        """CREATE TABLE IF NOT EXISTS http_cache (
+            url VARCHAR(255) PRIMARY KEY,
+            etag TEXT,
+            modified TEXT,
+            digest CHAR(64) NOT NULL,
+            updated timestamp DEFAULT CURRENT_TIMESTAMP
+        )""",
+        """CREATE TABLE IF NOT EXISTS schedule (
+            link VARCHAR(255) NOT NULL,
+            target VARCHAR(32) NOT NULL,
+            scheduled_at REAL NOT NULL,
+            PRIMARY KEY (link, target)
+        )""",
+        """CREATE TABLE IF NOT EXISTS thumbnails (
+            link VARCHAR(255) PRIMARY KEY,
+            width INT NOT NULL,
+            status INT NOT NULL,
+            error TEXT,
+            updated timestamp DEFAULT CURRENT_TIMESTAMP
+        )""",
+    ],
+    # 4: Indexes for the post queue, the collector's high-water mark, and the feeds.
+    # The pending index only contains the papers that still need to be posted
+    # somewhere, already in the order that we post them.
+    [
+        "CREATE INDEX IF NOT EXISTS papers_volume_number ON papers (volume, number, link)",
+        "CREATE INDEX IF NOT EXISTS papers_pending ON papers (volume, number, link) WHERE " + PENDING_WHERE,
+        "CREATE INDEX IF NOT EXISTS papers_created ON papers (created)",
+    ],
+    # 5: Normalized authors and a full-text index over the titles and authors.
+    # The collector fills in paper_authors; the triggers keep papers_fts in sync.
+    [
+        """CREATE TABLE IF NOT EXISTS authors (
+            id INTEGER PRIMARY KEY,
+            name TEXT NOT NULL UNIQUE COLLATE NOCASE
+        )""",
+        """CREATE TABLE IF NOT EXISTS paper_authors (
+            link VARCHAR(255) NOT NULL,
+            author_id INT NOT NULL,
+            position INT NOT NULL,
+            PRIMARY KEY (link, position)
+        )""",
+        "CREATE INDEX IF NOT EXISTS paper_authors_author ON paper_authors (author_id, link)",
+        """CREATE VIRTUAL TABLE IF NOT EXISTS papers_fts USING fts5(
+            title, authors,
+            content='papers', content_rowid='rowid',
+            tokenize='unicode61 remove_diacritics 2'
+        )""",
+        """CREATE TRIGGER IF NOT EXISTS papers_fts_insert AFTER INSERT ON papers BEGIN
+            INSERT INTO papers_fts (rowid, title, authors) VALUES (new.rowid, new.title, new.authors);
+        END""",
+        """CREATE TRIGGER IF NOT EXISTS papers_fts_delete AFTER DELETE ON papers BEGIN
+            INSERT INTO papers_fts (papers_fts, rowid, title, authors) VALUES ('delete', old.rowid, old.title, old.authors);
+            DELETE FROM paper_authors WHERE link = old.link;
+        END""",
+        """CREATE TRIGGER IF NOT EXISTS papers_fts_update AFTER UPDATE OF title, authors ON papers BEGIN
+            INSERT INTO papers_fts (papers_fts, rowid, title, authors) VALUES ('delete', old.rowid, old.title, old.authors);
+            INSERT INTO papers_fts (rowid, title, authors) VALUES (new.rowid, new.title, new.authors);
+        END""",
+        "INSERT INTO papers_fts (papers_fts) VALUES ('rebuild')",
+        addAllPaperAuthors,
+    ],
+    # 6: Retry queue for failed posts. The row for a paper/target is removed
+    # when it gets posted and kept (with next_attempt NULL) when we give up.
+    [
+        """CREATE TABLE IF NOT EXISTS post_retries (
+            link VARCHAR(255) NOT NULL,
+            target VARCHAR(32) NOT NULL,
+            attempts INT NOT NULL DEFAULT 0,
+            last_error TEXT,
+            next_attempt REAL,
+            updated timestamp DEFAULT CURRENT_TIMESTAMP,
+            PRIMARY KEY (link, target)
+        )""",
+    ],
+    # 7: The feeds page through the papers in the order that they were
+    # collected (see pvldb-rss.py), which this index covers. It replaces
+    # papers_created since it starts with the same column.
+    [
+        "CREATE INDEX IF NOT EXISTS papers_collected ON papers (created, volume, number, link)",
+        "DROP INDEX IF EXISTS papers_created",
+    ],
+    # 8: Give papers an INTEGER PRIMARY KEY. The table used to have a TEXT
+    # primary key, so its implicit rowids could be renumbered by VACUUM, which
+    # would have silently broken papers_fts. The existing rowids are kept as
+    # the ids. The id goes last so that 'SELECT *' in pvldb-announce.py still works.
+    [
+        "DROP TRIGGER IF EXISTS papers_fts_insert",
+        "DROP TRIGGER IF EXISTS papers_fts_delete",
+        "DROP TRIGGER IF EXISTS papers_fts_update",
+        "DROP TABLE IF EXISTS papers_fts",
+        """CREATE TABLE papers_new (
+            link VARCHAR(255) NOT NULL UNIQUE,
+            title TEXT NOT NULL,
+            authors TEXT NOT NULL,
+            volume INT NOT NULL,
+            number INT NOT NULL,
+            published DATE NOT NULL,
+            twitter INT NOT NULL DEFAULT 0,
+            mastodon INT NOT NULL DEFAULT 0,
+            created timestamp DEFAULT CURRENT_TIMESTAMP,
+            bluesky INT NOT NULL DEFAULT 0,
+            id INTEGER PRIMARY KEY
+        )""",
+        """INSERT INTO papers_new (id, link, title, authors, volume, number, published,
+                                   twitter, mastodon, created, bluesky)
+           SELECT rowid, link, title, authors, volume, number, published,
+                  twitter, mastodon, created, bluesky
+             FROM papers ORDER BY rowid""",
+        "DROP TABLE papers",
+        "ALTER TABLE papers_new RENAME TO papers",
+        "CREATE INDEX papers_volume_number ON papers (volume, number, link)",
+        "CREATE INDEX papers_pending ON papers (volume, number, link) WHERE " + PENDING_WHERE,
+        "CREATE INDEX papers_collected ON papers (created, volume, number, link)",
+        """CREATE VIRTUAL TABLE papers_fts USING fts5(
+            title, authors,
+            content='papers', content_rowid='id',
+            tokenize='unicode61 remove_diacritics 2'
+        )""",
+        """CREATE TRIGGER papers_fts_insert AFTER INSERT ON papers BEGIN
+            INSERT INTO papers_fts (rowid, title, authors) VALUES (new.id, new.title, new.authors);
+        END""",
+        """CREATE TRIGGER papers_fts_delete AFTER DELETE ON papers BEGIN
+            INSERT INTO papers_fts (papers_fts, rowid, title, authors) VALUES ('delete', old.id, old.title, old.authors);
+            DELETE FROM paper_authors WHERE link = old.link;
+        END""",
+        """CREATE TRIGGER papers_fts_update AFTER UPDATE OF title, authors ON papers BEGIN
+            INSERT INTO papers_fts (papers_fts, rowid, title, authors) VALUES ('delete', old.id, old.title, old.authors);
+            INSERT INTO papers_fts (rowid, title, authors) VALUES (new.id, new.title, new.authors);
+        END""",
+        "INSERT INTO papers_fts (papers_fts) VALUES ('rebuild')",
+    ],
+]
+
+## ==============================================
+## getPendingWhere
+## ==============================================
+def getPendingWhere(targets):
+    """Return the WHERE clause for the papers that still need to be posted to at least one of the targets"""
+    where = " OR ".join("%s = %d" % (t, PostStatus.PENDING.value) for t in targets)
+    return "(%s) AND (%s)" % (PENDING_WHERE, where)
+## DEF
+
+## ==============================================
+## splitAuthors
+## ==============================================
+def splitAuthors(authors):
+    """The website gives us the authors of a paper as one comma-separated string"""
+    return [ a.strip() for a in authors.split(",") if a.strip() ]
+## DEF
+
+## ==============================================
+## addPaperAuthors
+## ==============================================
+def addPaperAuthors(db, rows):
+    """
+    Add the normalized authors for the given (link, authors) pairs.
+    Papers that already have their authors are skipped. This does not commit.
+    """
+    entries = [ ]
+    for link, authors in rows:
+        for position, name in enumerate(splitAuthors(authors)):
+            entries.append((link, position, name))
+    ## FOR
+    cur = db.cursor()
+    cur.executemany("INSERT OR IGNORE INTO authors (name) VALUES (?)", [ (e[2],) for e in entries ])
+    cur.executemany("""INSERT OR IGNORE INTO paper_authors (link, position, author_id)
+                       SELECT ?, ?, id FROM authors WHERE name = ?""", entries)
+## DEF
+
+## ==============================================
+## getMatchPhrase
+## ==============================================
+def getMatchPhrase(text, column=None):
+    """
+    Turn arbitrary text into an FTS5 phrase so that quotes and operators
+    in it are matched literally instead of being parsed as query syntax.
+    """
+    phrase = '"%s"' % text.replace('"', '""')
+    if column is not None:
+        phrase = "%s : %s" % (column, phrase)
+    return phrase
+## DEF
+
+## ==============================================
+## getSchemaVersion
+## ==============================================
+def getSchemaVersion(db):
+    return db.execute("PRAGMA user_version").fetchone()[0]
+## DEF
+
+## ==============================================
+## migrateDatabase
+## ==============================================
+def migrateDatabase(db):
+    """
+    Bring the database schema up to date. Every migration runs in its own
+    transaction together with the version bump, so a failed migration
+    leaves the database at the previous version.
+    Returns the number of migrations that were applied.
+    """
+    if getSchemaVersion(db) >= len(MIGRATIONS):
+        return 0
+
+    num_applied = 0
+    while True:
+        # Take the write lock before checking the version again in case
+        # another script is migrating the same database right now
+        db.execute("BEGIN IMMEDIATE")
+        try:
+            version = getSchemaVersion(db)
+            if version >= len(MIGRATIONS):
+                db.rollback()
+                break
+            migration = MIGRATIONS[version]
+            LOG.info("Migrating database schema to version %d", version+1)
+            for step in (migration if isinstance(migration, list) else [ migration ]):
+                if callable(step):
+                    step(db)
+                else:
+                    db.execute(step)
+            ## FOR
+            db.execute("PRAGMA user_version = %d" % (version+1))
+            db.commit()
+        except:
+            db.rollback()
+            raise
+        num_applied += 1
+    ## WHILE
+    return num_applied
+## DEF
+
+## ==============================================
+## configureDatabase
+## ==============================================
+def configureDatabase(db):
+    """
+    Put the database in WAL mode so that the collector, the poster, and the
+    feed generator can all use it at the same time. Readers never block
+    the writer and vice versa, and writers wait for each other's lock
+    instead of failing with 'database is locked'.
+    """
+    mode = db.execute("PRAGMA journal_mode = WAL").fetchone()[0]
+    if mode.lower() != "wal":
+        LOG.warning("Unable to enable WAL for the database [journal_mode=%s]", mode)
+    # With WAL this is still safe against application crashes. Only the
+    # last commits before a power failure could be lost.
+    db.execute("PRAGMA synchronous = NORMAL")
+    db.execute("PRAGMA temp_store = MEMORY")
+    db.execute("PRAGMA cache_size = -%d" % DB_CACHE_SIZE)
+    db.execute("PRAGMA mmap_size = %d" % DB_MMAP_SIZE)
+## DEF
+
+## ==============================================
+## openDatabase
+## ==============================================
+def openDatabase(path, create=False):
+    """Connect to the database and make sure that its schema is up to date"""
+    if not os.path.exists(path):
+        if not create:
+            raise Exception("Database file '%s' does not exist" % path)
+        LOG.info("Creating database file %s", path)
+    # The statement cache keeps the prepared statements for the queries
+    # that we run over and over again with different parameters
+    db = sqlite3.connect(path, timeout=DB_BUSY_TIMEOUT, cached_statements=DB_STATEMENT_CACHE)
+    configureDatabase(db)
+    migrateDatabase(db)
+    return db
+## DEF
+
+## ==============================================
+## closeDatabase
+## ==============================================
+def closeDatabase(db):
+    """Let SQLite update its query planner statistics if it needs to and then close"""
+    try:
+        db.execute("PRAGMA optimize")
+    except sqlite3.OperationalError as ex:
+        LOG.debug("Skipping 'PRAGMA optimize' [%s]", ex)
+    db.close()
+## DEF
+
+## ==============================================
+## CommitBatcher
+## ==============================================
+class CommitBatcher(object):
+    """
+    Commit after every 'size' changes or 'interval' seconds instead of
+    after every single one. Call commit() at the end for the rest.
+    """
+    def __init__(self, db, size=DB_COMMIT_BATCH, interval=DB_COMMIT_INTERVAL):
+        self.db = db
+        self.size = size
+        self.interval = interval
+        self.pending = 0
+        self.last_commit = time.time()
+
+    def add(self, num_changes=1):
+        self.pending += num_changes
+        if self.pending >= self.size or time.time() - self.last_commit >= self.interval:
+            self.commit()
+
+    def commit(self):
+        if self.pending:
+            LOG.debug("Committing %d changes", self.pending)
+        self.db.commit()
+        self.pending = 0
+        self.last_commit = time.time()
+## CLASS
@@ -0,0 +1,233 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import os
+import json
+import time
+import atexit
+import logging
+import tempfile
+import threading
+import functools
+from contextlib import contextmanager
+
+from config import *
+
+## ==============================================
+## LOGGING
+## ==============================================
+LOG = logging.getLogger(__name__)
+LOG_handler = logging.StreamHandler()
+LOG_formatter = logging.Formatter(fmt='%(asctime)s [%(funcName)s:%(lineno)03d] %(levelname)-5s: %(message)s',
+                                  datefmt='%m-%d-%Y %H:%M:%S')
+LOG_handler.setFormatter(LOG_formatter)
+LOG.addHandler(LOG_handler)
+LOG.setLevel(logging.INFO)
+
+## ==============================================
+## Registry
+## ==============================================
+# Every metric is keyed by its name and a sorted tuple of its labels.
+# The collector and the poster update them from several threads, so
+# everything goes through METRICS_LOCK. Nothing is shared across processes:
+# the workers in pvldb-thumbs.py keep their own copies that are thrown away.
+
+METRICS_LOCK = threading.Lock()
+COUNTERS = { }
+GAUGES = { }
+HISTOGRAMS = { }
+START_TIME = time.time()
+
+def getKey(name, labels):
+    return (name, tuple(sorted(labels.items())))
+## DEF
+
+## ==============================================
+## incrementCounter
+## ==============================================
+def incrementCounter(name, value=1, **labels):
+    """Add to a value that only ever goes up (e.g., the number of pages fetched)"""
+    key = getKey(name, labels)
+    with METRICS_LOCK:
+        COUNTERS[key] = COUNTERS.get(key, 0) + value
+## DEF
+
+## ==============================================
+## setGauge
+## ==============================================
+def setGauge(name, value, **labels):
+    """Record the current value of something that can go up and down"""
+    with METRICS_LOCK:
+        GAUGES[getKey(name, labels)] = value
+## DEF
+
+## ==============================================
+## observeValue
+## ==============================================
+def observeValue(name, value, **labels):
+    """Add a sample (usually a duration in seconds) to a histogram with the METRICS_BUCKETS"""
+    key = getKey(name, labels)
+    with METRICS_LOCK:
+        hist = HISTOGRAMS.get(key)
+        if hist is None:
+            hist = HISTOGRAMS[key] = {
+                "buckets":  [ 0 ] * len(METRICS_BUCKETS),
+                "count":    0,
+                "sum":      0.0,
+                "min":      value,
+                "max":      value,
+            }
+        for i, bound in enumerate(METRICS_BUCKETS):
+            if value <= bound:
+                hist["buckets"][i] += 1
+        hist["count"] += 1
+        hist["sum"] += value
+        hist["min"] = min(hist["min"], value)
+        hist["max"] = max(hist["max"], value)
+## DEF
+
+## ==============================================
+## timer
+## ==============================================
+@contextmanager
+def timer(name, **labels):
+    """Time the code in the 'with' block, whether it raises or not"""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        observeValue(name, time.perf_counter() - start, **labels)
+## DEF
+
+def timed(name, **labels):
+    """Decorator version of timer() for when we want to time a whole function"""
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with timer(name, **labels):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+## DEF
+
+## ==============================================
+## sleepFor
+## ==============================================
+def sleepFor(seconds, reason):
+    """time.sleep() that keeps track of how long we spent waiting and why"""
+    seconds = max(0, seconds)
+    incrementCounter("sleep_seconds_total", seconds, reason=reason)
+    time.sleep(seconds)
+## DEF
+
+## ==============================================
+## getMetrics
+## ==============================================
+def getMetrics():
+    """Return a JSON-friendly summary of everything that was recorded"""
+    def formatName(name, labels):
+        if not labels:
+            return name
+        return "%s{%s}" % (name, ",".join("%s=%s" % l for l in labels))
+
+    with METRICS_LOCK:
+        summary = {
+            "counters":     { formatName(*k): v for k, v in sorted(COUNTERS.items()) },
+            "gauges":       { formatName(*k): v for k, v in sorted(GAUGES.items()) },
+            "histograms":   { },
+        }
+        for key, hist in sorted(HISTOGRAMS.items()):
+            summary["histograms"][formatName(*key)] = {
+                "count":    hist["count"],
+                "sum":      hist["sum"],
+                "mean":     hist["sum"] / hist["count"],
+                "min":      hist["min"],
+                "max":      hist["max"],
+            }
+        ## FOR
+    return summary
+## DEF
+
+## ==============================================
+## formatPrometheus
+## ==============================================
+def formatPrometheus(job):
+    """
+    Return everything that was recorded in the Prometheus text format so that
+    node_exporter's textfile collector can pick it up. Every metric gets the
+    METRICS_PREFIX and a 'job' label with the name of the script.
+    """
+    def formatLabels(labels, extra=()):
+        labels = (("job", job),) + labels + tuple(extra)
+        return "{%s}" % ",".join('%s="%s"' % (k, str(v).replace("\\", "\\\\").replace('"', '\\"')) for k, v in labels)
+
+    lines = [ ]
+    types = set()
+    def addType(name, kind):
+        if name not in types:
+            lines.append("# TYPE %s %s" % (name, kind))
+            types.add(name)
+
+    with METRICS_LOCK:
+        for (name, labels), value in sorted(COUNTERS.items()):
+            name = METRICS_PREFIX + name
+            addType(name, "counter")
+            lines.append("%s%s %s" % (name, formatLabels(labels), repr(float(value))))
+        for (name, labels), value in sorted(GAUGES.items()):
+            name = METRICS_PREFIX + name
+            addType(name, "gauge")
+            lines.append("%s%s %s" % (name, formatLabels(labels), repr(float(value))))
+        for (name, labels), hist in sorted(HISTOGRAMS.items()):
+            name = METRICS_PREFIX + name
+            addType(name, "histogram")
+            for bound, count in zip(METRICS_BUCKETS, hist["buckets"]):
+                lines.append("%s_bucket%s %d" % (name, formatLabels(labels, [ ("le", repr(float(bound))) ]), count))
+            lines.append("%s_bucket%s %d" % (name, formatLabels(labels, [ ("le", "+Inf") ]), hist["count"]))
+            lines.append("%s_sum%s %s" % (name, formatLabels(labels), repr(hist["sum"])))
+            lines.append("%s_count%s %d" % (name, formatLabels(labels), hist["count"]))
+        ## FOR
+    return "\n".join(lines) + "\n"
+## DEF
+
+## ==============================================
+## writeMetrics
+## ==============================================
+def writeMetrics(path, job):
+    """
+    Write the metrics to the given file. If it ends in '.prom' then it is in
+    the Prometheus text format, otherwise it is a JSON summary. The file is
+    replaced atomically so that nothing ever reads half of it.
+    """
+    setGauge("run_duration_seconds", time.time() - START_TIME)
+    setGauge("last_run_timestamp_seconds", time.time())
+    if path.endswith(".prom"):
+        data = formatPrometheus(job)
+    else:
+        data = json.dumps(dict(job=job, **getMetrics()), indent=2) + "\n"
+
+    dirname = os.path.dirname(os.path.abspath(path))
+    fd, tmp_path = tempfile.mkstemp(dir=dirname, prefix=".metrics-")
+    try:
+        with os.fdopen(fd, "w") as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+    except:
+        os.remove(tmp_path)
+        raise
+    LOG.debug("Wrote metrics to '%s'", path)
+## DEF
+
+## ==============================================
+## enableMetrics
+## ==============================================
+def enableMetrics(path, job):
+    """Write the metrics to the file when the script exits (if path is set)"""
+    if not path:
+        return
+    def onExit():
+        try:
+            writeMetrics(path, job)
+        except Exception:
+            LOG.exception("Failed to write metrics to '%s'", path)
+    atexit.register(onExit)
+## DEF
@@ -0,0 +1,89 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import sys
+import logging
+import argparse
+
+from config import *
+from database import openDatabase, closeDatabase, getPendingWhere
+from metrics import enableMetrics, incrementCounter
+from thumbnails import getImage, getPaperImageWidth, pruneCache, verifyCache, getCacheStats
+
+## ==============================================
+## LOGGING
+## ==============================================
+LOG = logging.getLogger(__name__)
+LOG_handler = logging.StreamHandler()
+LOG_formatter = logging.Formatter(fmt='%(asctime)s [%(funcName)s:%(lineno)03d] %(levelname)-5s: %(message)s',
+                                  datefmt='%m-%d-%Y %H:%M:%S')
+LOG_handler.setFormatter(LOG_formatter)
+LOG.addHandler(LOG_handler)
+LOG.setLevel(logging.INFO)
+
+## ==============================================
+## main
+## ==============================================
+if __name__ == '__main__':
+    aparser = argparse.ArgumentParser(description='PVLDB Thumbnail Cache Script')
+    aparser.add_argument('dbpath', help='Database Path')
+    aparser.add_argument("--debug", action='store_true')
+
+    aparser.add_argument('--prewarm', action='store_true', help='Download and render thumbnails for papers that have not been posted yet')
+    aparser.add_argument('--limit', type=int, help='Number of papers to prewarm')
+    aparser.add_argument('--width', type=int, help='Thumbnail width in pixels (default: the width that the pending targets need)')
+    aparser.add_argument('--targets', type=str, default=",".join(POST_IMAGE_LIMITS.keys()), help='Comma-separated post targets to render the thumbnails for')
+    aparser.add_argument('--verify', action='store_true', help='Remove corrupted files from the cache')
+    aparser.add_argument('--prune', action='store_true', help='Evict the least recently used files until the cache fits in --max-size')
+    aparser.add_argument('--max-size', type=int, default=CACHE_MAX_SIZE // (1024 * 1024), help='Maximum cache size in MB')
+    aparser.add_argument('--metrics', type=str, default=METRICS_FILE, help='Write timers and counters to this file at exit (.prom for Prometheus, otherwise JSON)')
+
+    args = vars(aparser.parse_args())
+    enableMetrics(args["metrics"], "pvldb-cache")
+
+    ## ----------------------------------------------
+    
+    if args['debug']:
+        LOG.setLevel(logging.DEBUG)
+        logging.getLogger("thumbnails").setLevel(logging.DEBUG)
+
+    ## ----------------------------------------------
+
+    if args["verify"]:
+        LOG.info("Removed %d corrupted files from '%s'", verifyCache(), CACHE_DIR)
+
+    if args["prewarm"]:
+        db = openDatabase(args['dbpath'])
+        cur = db.cursor()
+
+        # Render each thumbnail at the width that the poster is going to ask for
+        targets = args["targets"].split(",")
+        for target in targets:
+            if target not in POST_IMAGE_LIMITS:
+                LOG.error("Unknown post target '%s'", target)
+                sys.exit(1)
+        sql = "SELECT link, %s FROM papers WHERE %s ORDER BY volume ASC, number ASC, link" % \
+              (", ".join(targets), getPendingWhere(targets))
+        links = [ ]
+        for row in cur.execute(sql):
+            width = args["width"] or getPaperImageWidth(dict(zip(targets, row[1:])), targets)
+            links.append((row[0], width))
+        closeDatabase(db)
+        if args["limit"]:
+            links = links[:args["limit"]]
+
+        for i, (link, width) in enumerate(links):
+            LOG.info("Prewarming [%d/%d] %s", i+1, len(links), link)
+            try:
+                getImage(link, width)
+            except Exception:
+                LOG.exception("Failed to create thumbnail for '%s'", link)
+                incrementCounter("thumbnail_failures_total")
+        ## FOR
+
+    if args["prune"]:
+        LOG.info("Evicted %d files from '%s'", pruneCache(args["max_size"] * 1024 * 1024), CACHE_DIR)
+
+    for subdir, (num_files, size) in getCacheStats().items():
+        LOG.info("%-6s: %5d files [%.1f MB]", subdir, num_files, size / (1024 * 1024))
+## MAIN
@@ -1,7 +1,6 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
-import os
 import sys
 import re
 import urllib.request, urllib.parse, urllib.error
@@ -9,14 +8,18 @@ import logging
 import pytz
 import time
 import argparse
-import sqlite3
 import json
+import hashlib
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from datetime import datetime
 from datetime import tzinfo
 from pprint import pprint, pformat
 from bs4 import BeautifulSoup
 
 from config import *
+from database import openDatabase, closeDatabase, addPaperAuthors
+from metrics import enableMetrics, incrementCounter, timer, timed
 
 ## ==============================================
 ## LOGGING
@@ -29,73 +32,219 @@ LOG_handler.setFormatter(LOG_formatter)
 LOG.addHandler(LOG_handler)
 LOG.setLevel(logging.INFO)
 
+# Per-host semaphores so that we never have more than COLLECT_MAX_PER_HOST
+# requests in flight against the same server (i.e., vldb.org)
+HOST_LIMITS = { }
+HOST_LIMITS_LOCK = threading.Lock()
+
+# The <script> tag with the JSON object that Next.js embeds in each volume page
+JSON_SCRIPT_RE = re.compile(rb'<script\b[^>]*\btype=["\']application/json["\'][^>]*>(.*?)</script\s*>', re.S | re.I)
+
 ## ==============================================
-## getVolumeUrls
+## getHostLimit
 ## ==============================================
-def getVolumeUrls(url):
-    volumes = [ ]
-    
-    # Brute force search for volumes
-    for vol in range(15,16):
-        url = START_URL % vol
-        LOG.debug("Checking whether volume '%s' exists" % url)
+def getHostLimit(url):
+    host = urllib.parse.urlparse(url).netloc
+    with HOST_LIMITS_LOCK:
+        if not host in HOST_LIMITS:
+            HOST_LIMITS[host] = threading.BoundedSemaphore(COLLECT_MAX_PER_HOST)
+        return HOST_LIMITS[host]
+## DEF
+
+## ==============================================
+## fetchUrl
+## ==============================================
+def fetchUrl(url, cache=None):
+    """
+    Download the given URL. If a cache dict is given, then we will send a
+    conditional GET using the ETag/Last-Modified from the last time we fetched it.
+    Returns None if the server says that the page has not been modified or
+    if the body is identical to what we saw last time.
+    """
+    request = urllib.request.Request(url)
+    entry = cache.get(url) if cache is not None else None
+    if entry:
+        if entry["etag"]:
+            request.add_header("If-None-Match", entry["etag"])
+        if entry["modified"]:
+            request.add_header("If-Modified-Since", entry["modified"])
+
+    with getHostLimit(url):
+        LOG.debug("Fetching %s", url)
         try:
-            r = urllib.request.urlopen(url).read()
-            if not url in volumes:
-                volumes.append(url)
-        except:
-            LOG.debug("Volume #%d does not exist. Skipping..." % vol)
-            pass
+            with timer("http_request_seconds"):
+                with urllib.request.urlopen(request, timeout=COLLECT_TIMEOUT) as response:
+                    html = response.read()
+                    headers = response.headers
+        except urllib.error.HTTPError as ex:
+            incrementCounter("pages_fetched_total", status=ex.code)
+            if ex.code == 304:
+                LOG.debug("Not modified %s", url)
+                return None
+            raise
+    incrementCounter("pages_fetched_total", status=200)
+    incrementCounter("bytes_downloaded_total", len(html), source="volume")
+
+    if cache is None:
+        return html
+
+    digest = hashlib.sha256(html).hexdigest()
+    cache[url] = {
+        "etag":     headers.get("ETag"),
+        "modified": headers.get("Last-Modified"),
+        "digest":   digest,
+    }
+    if entry and entry["digest"] == digest:
+        LOG.debug("Content unchanged %s", url)
+        return None
+    return html
+## DEF
+
+## ==============================================
+## loadHttpCache
+## ==============================================
+def loadHttpCache(db):
+    cur = db.cursor()
+    cache = { }
+    for row in cur.execute("SELECT url, etag, modified, digest FROM http_cache"):
+        cache[row[0]] = {
+            "etag":     row[1],
+            "modified": row[2],
+            "digest":   row[3],
+        }
+    ## FOR
+    return cache
+## DEF
+
+## ==============================================
+## saveHttpCache
+## ==============================================
+def saveHttpCache(db, cache):
+    # This does not commit so that the cache entries are only stored in
+    # the same transaction as the papers that we extracted from them
+    sql = """INSERT OR REPLACE INTO http_cache (
+                url, etag, modified, digest, updated
+            ) VALUES (
+                ?, ?, ?, ?, CURRENT_TIMESTAMP)"""
+    cur = db.cursor()
+    cur.executemany(sql, [ (url, e["etag"], e["modified"], e["digest"]) for url, e in cache.items() ])
+## DEF
+
+## ==============================================
+## volumeExists
+## ==============================================
+def volumeExists(volume):
+    url = START_URL % volume
+    LOG.debug("Checking whether volume '%s' exists", url)
+    request = urllib.request.Request(url, method="HEAD")
+    try:
+        try:
+            with getHostLimit(url):
+                urllib.request.urlopen(request, timeout=COLLECT_TIMEOUT).close()
+        except urllib.error.HTTPError as ex:
+            if ex.code not in (405, 501):
+                raise
+            # The server does not do HEAD requests, so get the whole page instead.
+            # This skips the HTTP cache so that collecting the volume afterwards
+            # does not think that it has already seen the page.
+            LOG.debug("HEAD is not allowed for '%s' [status=%d]. Using GET", url, ex.code)
+            fetchUrl(url)
+    except urllib.error.HTTPError as ex:
+        LOG.debug("Volume #%d does not exist [status=%d]", volume, ex.code)
+        return False
+    except urllib.error.URLError as ex:
+        LOG.warning("Failed to check whether volume #%d exists: %s", volume, ex.reason)
+        return False
+    return True
+## DEF
+
+## ==============================================
+## getHighWaterMark
+## ==============================================
+def getHighWaterMark(db):
+    """Return the largest volume that we have collected papers for (or None)"""
+    cur = db.cursor()
+    cur.execute("SELECT MAX(volume) FROM papers")
+    return cur.fetchone()[0]
+## DEF
+
+## ==============================================
+## getLiveVolumes
+## ==============================================
+def getLiveVolumes(start):
+    """
+    Return the volumes that we should collect, starting with the given volume.
+    We assume that 'start' is live and then probe up to COLLECT_MAX_NEW_VOLUMES
+    after it with HEAD requests until we find one that does not exist yet.
+    """
+    volumes = [ start ]
+    for volume in range(start + 1, start + 1 + COLLECT_MAX_NEW_VOLUMES):
+        if not volumeExists(volume):
+            break
+        LOG.info("Volume #%d is live", volume)
+        volumes.append(volume)
+    else:
+        LOG.warning("Stopped probing after volume #%d. Check that the server returns 404 for unknown volumes", volumes[-1])
     ## FOR
-    assert len(volumes) > 0    
     return volumes
-        
-    #soup = BeautifulSoup(r, "lxml")
-    #regex = re.compile("\/vol[\d]+-volume-info\.html")
-    #for a in soup.find_all('a'):
-        #if not "href" in a.attrs:
-            ## pprint(a.__dict__)
-            #LOG.warning("No 'href' tag found. Skipping '%s'" % str(a))
-            #continue
-        
-        #m = regex.search(a["href"])
-        #if a["href"].find("/pvldb/vol") != -1:
-            #pprint(a.__dict__)
-            #pprint(m)
-            #print("="*20)
-        #if m and not a["href"] in volumes:
-            #if a["href"] in SKIP:
-                #LOG.warning("Skipping '%s'" % a["href"])
-                #continue
-            #volumes.append(a["href"])
-    ### FOR
-    #assert len(volumes) > 0    
-    #return [ BASE_URL + x for x in volumes ]
+## DEF
+
+## ==============================================
+## extractJson
+## ==============================================
+def extractJson(html):
+    """
+    Return the JSON object embedded in a volume page or None if it is missing.
+    We scan the raw bytes for the <script> tag instead of building the whole
+    DOM, and only fall back to BeautifulSoup if that does not work.
+    """
+    if isinstance(html, str):
+        html = html.encode("utf-8")
+    m = JSON_SCRIPT_RE.search(html)
+    if m:
+        try:
+            return json.loads(m.group(1))
+        except ValueError:
+            LOG.warning("Failed to decode embedded JSON data. Falling back to BeautifulSoup")
+    else:
+        LOG.debug("Unable to find JSON <script> tag. Falling back to BeautifulSoup")
+    return extractJsonSoup(html)
+## DEF
+
+def extractJsonSoup(html):
+    soup = BeautifulSoup(html, "lxml")
+    data = soup.find('script', type="application/json")
+    if not data:
+        return None
+    return json.loads(data.contents[0])
 ## DEF
 
 ## ==============================================
 ## getPapers
 ## ==============================================
-def getPapers(volume, vol_url):
+@timed("collect_volume_seconds")
+def getPapers(volume, vol_url, cache=None):
     LOG.debug("Retreiving papers for %s", vol_url)
 
     vol_papers = { }
     html = None
     # with open("/tmp/pvldb.html", "r") as fd:
     #     html = fd.read()
-    html = urllib.request.urlopen(vol_url).read()
+    html = fetchUrl(vol_url, cache)
+    if html is None:
+        LOG.info("Volume %d has not changed since the last collection. Skipping...", volume)
+        return (vol_papers)
     # with open("/tmp/pvldb.html", "wb") as fd:
     #     fd.write(html)
-    soup = BeautifulSoup(html, "lxml")
 
     # They embed a JSON object in the HTML that we can use to extract the data we need
     # This is way easier than messing around with parsing HTML
-    data = soup.find('script', type="application/json")
-    if not data:
+    with timer("parse_seconds"):
+        json_data = extractJson(html)
+    if json_data is None:
         LOG.error("Unable to find JSON data from %s", vol_url)
         return (vol_papers)
 
-    json_data = json.loads(data.contents[0])
     try:
         volume_data = json_data["props"]["pageProps"]["groupedIssues"]
     except:
@@ -119,32 +268,69 @@ def getPapers(volume, vol_url):
             })
         key = (volume, number)
         vol_papers[key] = papers
+        incrementCounter("papers_found_total", len(papers))
         LOG.debug("Found %d papers for 'Vol:%d, Number:%d'\n%s", len(papers), volume, number, pformat(papers))
 
     return (vol_papers)
 
 ## ==============================================
-## createDatabase
+## collectPapers
 ## ==============================================
-def createDatabase():
-    db = sqlite3.connect(DB_PATH)
+def collectPapers(volumes, jobs=1, cache=None):
+    """
+    Download and parse the given volumes, using up to 'jobs' threads.
+    Returns the merged dict of (volume, number) -> papers for all volumes.
+    """
+    papers = { }
+    if jobs <= 1 or len(volumes) <= 1:
+        for vol in volumes:
+            p = getPapers(vol, START_URL % vol, cache)
+            if p: papers.update(p)
+        return (papers)
+
+    LOG.debug("Collecting %d volumes with %d threads", len(volumes), jobs)
+    with ThreadPoolExecutor(max_workers=jobs) as pool:
+        futures = { pool.submit(getPapers, vol, START_URL % vol, cache): vol for vol in volumes }
+        for f in as_completed(futures):
+            p = f.result()
+            LOG.debug("Finished collecting volume %d [#numbers=%d]", futures[f], len(p))
+            if p: papers.update(p)
+        ## FOR
+    return (papers)
+## DEF
+
+## ==============================================
+## insertPapers
+## ==============================================
+@timed("insert_seconds")
+def insertPapers(db, papers):
+    """
+    Insert all of the given papers with a single batched statement, skipping
+    the ones that are already in the database, along with their authors.
+    This does not commit. Returns the number of papers that were new.
+    """
+    # Oldest issue first so that the rowids follow the order of the issues
+    rows = [ ]
+    for key in sorted(papers.keys()):
+        LOG.debug("KEY=%s -> #papers=%d", key, len(papers[key]))
+        for p in papers[key]:
+            rows.append((p["link"], p["title"], p["authors"], p["volume"], p["number"], p["published"],))
+    ## FOR
+
+    sql = """INSERT INTO papers (
+                link, title, authors, volume, number, published
+            ) VALUES (
+                ?, ?, ?, ?, ?, ?)
+            ON CONFLICT(link) DO NOTHING"""
     cur = db.cursor()
-    
-    sql = """
-    CREATE TABLE papers (
-        link VARCHAR(255) PRIMARY KEY,
-        title TEXT NOT NULL,
-        authors TEXT NOT NULL,
-        volume INT NOT NULL,
-        number INT NOT NULL,
-        published DATE NOT NULL,
-        twitter INT NOT NULL DEFAULT 0,
-        mastodon INT NOT NULL DEFAULT 0,
-        created timestamp DEFAULT CURRENT_TIMESTAMP
-    );"""
-    cur.execute(sql)
-    db.commit()
-    db.close()
+    cur.executemany(sql, rows)
+    # This is only the rows that the INSERT itself added, not the ones
+    # that the full-text index triggers added
+    num_new = cur.rowcount
+    addPaperAuthors(db, [ (r[0], r[2]) for r in rows ])
+    incrementCounter("papers_inserted_total", num_new)
+    return num_new
+## DEF
 
 ## ==============================================
 ## main
@@ -154,13 +340,18 @@ if __name__ == '__main__':
     aparser.add_argument('dbpath', help='Database Path')
     aparser.add_argument("--debug", action='store_true')
     aparser.add_argument("--dry-run", action='store_true')
+    aparser.add_argument("--no-cache", action='store_true', help='Ignore cached HTTP responses and reparse every volume')
+    aparser.add_argument('--metrics', type=str, default=METRICS_FILE, help='Write timers and counters to this file at exit (.prom for Prometheus, otherwise JSON)')
 
     ## Collection Parameters
     agroup = aparser.add_argument_group('Collection Parameters')
     agroup.add_argument('--collect-start', type=int, help='Start volume to check')
     agroup.add_argument('--collect-stop', type=int, help='Stop volume to check (inclusive)')
+    agroup.add_argument('--collect-auto', action='store_true', help='Only check the latest volume in the database and any newer ones that are live')
+    agroup.add_argument('--jobs', type=int, default=COLLECT_JOBS, help='Number of volumes to download in parallel')
     
     args = vars(aparser.parse_args())
+    enableMetrics(args["metrics"], "pvldb-collect")
 
     ## ----------------------------------------------
     
@@ -170,42 +361,41 @@ if __name__ == '__main__':
     ## ----------------------------------------------
     
     # Create the database if we don't have it
-    if not os.path.exists(args['dbpath']):
-        LOG.info("Creating database file %s", args['dbpath'])
-        createDatabase()
-    db = sqlite3.connect(args['dbpath'])
+    db = openDatabase(args['dbpath'], create=True)
     cur = db.cursor()
         
     # Get the volume URLs
-    papers = { }
-    for vol in range(args["collect_start"], args["collect_stop"]+1):
-        url = START_URL % vol
-        p = getPapers(vol, url)
-        if p: papers.update(p)
+    if args["collect_auto"]:
+        # Start from the largest volume that we already know about
+        start = getHighWaterMark(db)
+        if start is None:
+            start = args["collect_start"]
+        if start is None:
+            LOG.error("The database is empty so '--collect-start' is required with '--collect-auto'")
+            sys.exit(1)
+        volumes = getLiveVolumes(start)
+    else:
+        if args["collect_start"] is None or args["collect_stop"] is None:
+            LOG.error("Missing '--collect-start' and '--collect-stop' (or use '--collect-auto')")
+            sys.exit(1)
+        volumes = list(range(args["collect_start"], args["collect_stop"]+1))
+    LOG.debug("Collecting volumes %s", volumes)
+    cache = loadHttpCache(db)
+    if args["no_cache"]:
+        LOG.debug("Ignoring %d cached HTTP responses", len(cache))
+        cache = { }
+    papers = collectPapers(volumes, args["jobs"], cache)
 
     # Figure out what papers are new
-    for key in reversed(sorted(papers.keys())):
-        LOG.debug("KEY=%s -> #papers=%d", key, len(papers[key]))
-        for p in papers[key]:
-            LOG.debug("Checking whether paper '%s' already exists...", os.path.basename(p["link"]))
-            sql = "SELECT * FROM papers WHERE link = ?"
-            cur.execute(sql, (p["link"],))
-            row = cur.fetchone()
-            if row is None:
-                LOG.debug("Adding %s" % p["link"])
-
-                sql = """INSERT INTO papers (
-                            link, title, authors, volume, number, published
-                        ) VALUES (
-                            ?, ?, ?, ?, ?, ?)"""
-                if not args["dry_run"]:
-                    cur.execute(sql, (p["link"], p["title"], p["authors"], p["volume"], p["number"], p["published"],))
-                else:
-                    LOG.debug("Not inserting because dry-run is enabled")
-        ## FOR
-    ## FOR
-    db.commit()
-    db.close()
+    num_new = insertPapers(db, papers)
+    if not args["dry_run"]:
+        saveHttpCache(db, cache)
+        db.commit()
+    else:
+        LOG.debug("Not inserting because dry-run is enabled")
+        db.rollback()
+    LOG.info("Found %d new papers [total=%d]", num_new, sum(map(len, papers.values())))
+    closeDatabase(db)
 ## MAIN
     
     
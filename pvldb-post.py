@@ -2,23 +2,28 @@
 # -*- coding: utf-8 -*-
 
 import os
+import io
 import logging
 import time
 import argparse
-import sqlite3
 import requests
-import tempfile
 import sys
-from PIL import Image
-from pdf2image import convert_from_path
+import random
+import threading
+import functools
+from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 from pdf2image.exceptions import PDFPageCountError
 from pprint import pprint, pformat
 
 import tweepy
-from mastodon import Mastodon
-from atproto import Client, client_utils
+from mastodon import Mastodon, MastodonRatelimitError
+from atproto import Client, Request, client_utils
 
 from config import *
+from database import openDatabase, closeDatabase, getPendingWhere, getMatchPhrase
+from thumbnails import getImage, getImageWidth, resizeImage, InvalidFileError
+from metrics import enableMetrics, writeMetrics, incrementCounter, sleepFor, timed
 
 ## ==============================================
 ## LOGGING
@@ -31,79 +36,184 @@ LOG_handler.setFormatter(LOG_formatter)
 LOG.addHandler(LOG_handler)
 LOG.setLevel(logging.INFO)
 
-## ==============================================
-## getImage
-## ==============================================
-def getImage(pdf_url):
-    LOG.debug("Create thumbnail for '%s'", pdf_url)
-    # Get the filename from the URL
-    temp_dir = tempfile.gettempdir()
-    pdf_filename = "pvldb-" + os.path.basename(pdf_url)
-    pdf_path = os.path.join(temp_dir, pdf_filename)
+# The authenticated API clients for each post target
+# We only want to log in once per process and then reuse the same connections
+CLIENTS = { }
 
-    # Download the PDF file
-    if not os.path.exists(pdf_path):
-        response = requests.get(pdf_url)
-        with open(pdf_path, 'wb') as pdf_file:
-            pdf_file.write(response.content)
-            LOG.debug(f"Downloaded PDF {pdf_path}")
-    else:
-        LOG.debug(f"Reusing cached PDF {pdf_path}")
-
-    # Convert the downloaded PDF to PNG images
-    img_filename = f'{pdf_filename}.png'
-    img_path = os.path.join(temp_dir, img_filename)
-    if not os.path.exists(img_path):
-        images = convert_from_path(pdf_path, first_page=0, last_page=1)
-        if images:
-            images[0].save(img_path, 'PNG')
-            LOG.debug(f'Conversion successful. Image saved in temporary directory: {img_path}')
-    else:
-        LOG.debug(f'Reusing existing image: {img_path}')
-    return img_path
+# The RateLimiter for each post target
+LIMITERS = { }
+
+# The (paper, target, future) for the posts that timed out but whose threads
+# are still running. See resolvePosts().
+UNRESOLVED = [ ]
 
 ## ==============================================
-## resizeImage
+## RateLimiter
 ## ==============================================
-def resizeImage(img_path, max_size_kb: int, step=5):
+class RateLimiter:
     """
-    Resize a PNG file incrementally until its size is below the given threshold.
-
-    :param img_path: Path to the PNG file.
-    :param max_size_kb: Maximum allowed file size in KB.
-    :param step: Percentage decrease in image size per iteration.
+    Token bucket for a single post target. It refills at the rate given in
+    POST_RATE_LIMITS, but whenever the API tells us how many requests we have
+    left and when that resets, we trust that over our own accounting.
     """
-    max_size_bytes = max_size_kb * 1024
+    def __init__(self, target, capacity, period):
+        self.target = target
+        self.capacity = capacity
+        self.rate = capacity / period # tokens per second
+        self.tokens = float(capacity)
+        self.updated = time.time()
+        self.blocked_until = 0
+        self.lock = threading.Lock()
+
+    def _refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def acquire(self):
+        """Block until we are allowed to post to this target"""
+        while True:
+            with self.lock:
+                now = time.time()
+                self._refill(now)
+                wait = self.blocked_until - now
+                if wait <= 0:
+                    if self.tokens >= 1:
+                        self.tokens -= 1
+                        return
+                    wait = (1 - self.tokens) / self.rate
+            LOG.warning("Rate limit reached for %s. Waiting for %d seconds...", self.target, wait)
+            sleepFor(wait, "rate_limit")
+        ## WHILE
+
+    def readyAt(self):
+        """Return the time when acquire() will be able to go without waiting (0 if it can right now)"""
+        with self.lock:
+            now = time.time()
+            self._refill(now)
+            ready = 0 if self.tokens >= 1 else now + (1 - self.tokens) / self.rate
+            return max(ready, self.blocked_until)
+
+    def update(self, headers):
+        """Sync the bucket with the rate-limit headers from an API response"""
+        remaining, reset = parseRateLimitHeaders(headers)
+        if remaining is None:
+            return
+        with self.lock:
+            self._refill(time.time())
+            self.tokens = min(self.tokens, remaining)
+            if remaining <= 0 and reset:
+                self.blocked_until = max(self.blocked_until, reset)
+        LOG.debug("%s rate limit [remaining=%d, reset=%s]", self.target, remaining, reset)
+
+    def backoff(self, attempt):
+        """We got a 429, so stop until the reset time (if we know it) or back off exponentially"""
+        with self.lock:
+            now = time.time()
+            self.tokens = 0
+            self.updated = now
+            if self.blocked_until <= now:
+                self.blocked_until = now + POST_RATE_BACKOFF * (2 ** attempt)
+            LOG.warning("Throttled by %s. Backing off for %d seconds", self.target, self.blocked_until - now)
+## CLASS
 
-    if os.path.getsize(img_path) <= max_size_bytes:
-      return img_path
+## ==============================================
+## parseRateLimitHeaders
+## ==============================================
+def parseRateLimitHeaders(headers):
+    """
+    Return the (remaining, reset) values from the rate-limit headers of a response.
+    Twitter and Bluesky send the reset time as a Unix timestamp, while Mastodon
+    sends an ISO 8601 date.
+    """
+    remaining = None
+    reset = None
+    for prefix in ("x-rate-limit-", "x-ratelimit-", "ratelimit-"):
+        if headers.get(prefix + "remaining") is None:
+            continue
+        try:
+            remaining = int(headers[prefix + "remaining"])
+            value = headers.get(prefix + "reset")
+            if value:
+                if value.isdigit():
+                    reset = int(value)
+                else:
+                    reset = datetime.fromisoformat(value).timestamp()
+        except ValueError:
+            LOG.debug("Invalid rate limit headers: %s", dict(headers))
+        break
+    ## FOR
+    return (remaining, reset)
+## DEF
 
-    image = Image.open(img_path)
-    width, height = image.size
-    LOG.debug(f"Compressing Image '{img_path}' // (width={width}, height={height}) // File Size: {os.path.getsize(img_path) / 1024:.2f} KB")
+## ==============================================
+## getLimiter
+## ==============================================
+def getLimiter(target):
+    if not target in LIMITERS:
+        LIMITERS[target] = RateLimiter(target, *POST_RATE_LIMITS[target])
+    return LIMITERS[target]
+## DEF
+
+def isRateLimited(ex):
+    if isinstance(ex, (tweepy.TooManyRequests, MastodonRatelimitError)):
+        return True
+    response = getattr(ex, "response", None)
+    return getattr(response, "status_code", None) == 429
+## DEF
 
-    # First try converting it to JPG to see if that makes it small enough
-    jpg_path = img_path.replace(".png", ".jpg")
-    image.convert("RGB").save(jpg_path, format='JPEG', quality=85, optimize=True)
-    if os.path.getsize(jpg_path) < max_size_bytes:
-        LOG.debug(f"Converted to JPG with file size: {os.path.getsize(jpg_path) / 1024:.2f} KB")
-        img_path = jpg_path
+## ==============================================
+## getClient
+## ==============================================
+def getClient(args, target):
+    if target in CLIENTS:
+        return CLIENTS[target]
+
+    LOG.debug("Creating new %s client", target)
+
+    # Feed the headers from every response into the target's rate limiter
+    limiter = getLimiter(target)
+    hook = lambda response, *a, **kw: limiter.update(response.headers)
+
+    # Every request has to give up before postPaper() gives up on the whole post
+    timeout = POST_REQUEST_TIMEOUT[target]
+    assert timeout < POST_TIMEOUT[target]
+
+    if target == "mastodon":
+        session = requests.Session()
+        session.hooks["response"].append(hook)
+        client = Mastodon(
+            access_token=args["mastodon_api_key"],
+            api_base_url=args["mastodon_url"],
+            ratelimit_method="throw",
+            request_timeout=timeout,
+            session=session
+        )
+    elif target == "bluesky":
+        # The client will refresh the session on its own when the access token expires
+        client = Client(request=Request(timeout=timeout, event_hooks={"response": [hook]}))
+        client.login(args["bluesky_handle"], args["bluesky_password"])
+    elif target == "twitter":
+        auth = tweepy.OAuthHandler(args['twitter_api_key'], args['twitter_api_secret'])
+        auth.set_access_token(args['twitter_access_token'], args['twitter_access_secret'])
+        client = (
+            tweepy.Client(
+                # bearer_token=args['twitter_bearer_token'],
+                consumer_key=args['twitter_api_key'],
+                consumer_secret=args['twitter_api_secret'],
+                access_token=args['twitter_access_token'],
+                access_token_secret=args['twitter_access_secret']
+            ),
+            tweepy.API(auth, timeout=timeout)
+        )
+        for c in client:
+            c.session.hooks["response"].append(hook)
+        # tweepy.Client does not have a timeout option, so give its session a default one
+        client[0].session.request = functools.partial(client[0].session.request, timeout=timeout)
     else:
-      LOG.debug("Incrementally resizing until image is small enough")
-      while os.path.getsize(img_path) > max_size_bytes:
-          width = int(width * (1 - step / 100))
-          height = int(height * (1 - step / 100))
-          image = image.resize((width, height), Image.LANCZOS)
-
-          temp_path = img_path.replace(".png", "_temp.png")
-          image.save(temp_path, format='PNG', optimize=True)
-
-          if os.path.getsize(temp_path) < max_size_bytes:
-              img_path = temp_path
-              break
-    LOG.debug(f"Final Image '{img_path}' // (width={width}, height={height}) // File Size: {os.path.getsize(img_path) / 1024:.2f} KB")
-
-    return img_path
+        raise Exception("Unexpected post target '%s'" % target)
+    CLIENTS[target] = client
+    return client
+## DEF
 
 def getAuthorCaption(paper):
     # Figure whether there is more than one author
@@ -128,13 +238,11 @@ def getPaperPost(paper, max_chars : int):
 ## ==============================================
 ## postMastodon
 ## ==============================================
+@timed("post_seconds", target="mastodon")
 def postMastodon(args, paper):
     LOG.info("Posting paper '%s' to Mastodon!", paper["title"])
 
-    api = Mastodon(
-        access_token=args["mastodon_api_key"],
-        api_base_url=args["mastodon_url"]
-    )
+    api = getClient(args, "mastodon")
 
     post = getPaperPost(paper, POST_MAX_NUM_CHARS["mastodon"])
     LOG.debug("%s [Length=%d]: %s", "mastodon", len(post), post)
@@ -145,7 +253,8 @@ def postMastodon(args, paper):
             if not args["no_caption"]:
                 caption = "Thumbnail: %(title)s" % paper
 
-            media = api.media_post(paper["image"], focus=(0, 0.85), description=caption)
+            img_data = resizeImage(paper["image"], POST_IMAGE_LIMITS["mastodon"][1])
+            media = api.media_post(io.BytesIO(img_data), mime_type="image/jpeg", focus=(0, 0.85), description=caption)
             status = api.status_post(post, visibility='public', media_ids=media)
         else:
             status = api.status_post(post, visibility='public')
@@ -158,11 +267,11 @@ def postMastodon(args, paper):
 ## ==============================================
 ## postBluesky
 ## ==============================================
+@timed("post_seconds", target="bluesky")
 def postBluesky(args, paper):
     LOG.info("Posting paper '%s' to Bluesky!", paper["title"])
 
-    api = Client()
-    api.login(args["bluesky_handle"], args["bluesky_password"])
+    api = getClient(args, "bluesky")
 
     post = getPaperPost(paper, POST_MAX_NUM_CHARS["bluesky"])
 
@@ -180,10 +289,8 @@ def postBluesky(args, paper):
             if not args["no_caption"]:
                 caption = "Thumbnail: %(title)s" % paper
 
-            # Bluesky has limits on image file size, so either convert it to a JPG or resize it
-            img_path = resizeImage(paper["image"], 950)
-            with open(img_path, 'rb') as f:
-                img_data = f.read()
+            # Bluesky has limits on image file size, so compress it until it fits
+            img_data = resizeImage(paper["image"], POST_IMAGE_LIMITS["bluesky"][1])
             status = api.send_image(text=builder, image=img_data, image_alt=caption)
         else:
             status = api.send_post(text=builder)
@@ -196,20 +303,11 @@ def postBluesky(args, paper):
 ## ==============================================
 ## postTwitter
 ## ==============================================
+@timed("post_seconds", target="twitter")
 def postTwitter(args, paper):
     LOG.info("Posting paper '%s' to twitter!" % paper["title"])
 
-    client = tweepy.Client(
-        # bearer_token=args['twitter_bearer_token'],
-        consumer_key=args['twitter_api_key'],
-        consumer_secret=args['twitter_api_secret'],
-        access_token=args['twitter_access_token'],
-        access_token_secret=args['twitter_access_secret']
-    )
-
-    auth = tweepy.OAuthHandler(args['twitter_api_key'], args['twitter_api_secret'])
-    auth.set_access_token(args['twitter_access_token'], args['twitter_access_secret'])
-    api = tweepy.API(auth)
+    client, api = getClient(args, "twitter")
 
     post = "Vol:%(volume)d No:%(number)d → %(title)s" % paper
     if len(post) + 24 > POST_MAX_NUM_CHARS["twitter"]:
@@ -220,7 +318,8 @@ def postTwitter(args, paper):
 
     if not args["dry_run"]:
         if not args['no_image'] and "image" in paper and paper["image"]:
-            media = api.media_upload(paper["image"])
+            img_data = resizeImage(paper["image"], POST_IMAGE_LIMITS["twitter"][1])
+            media = api.media_upload(os.path.basename(paper["image"]), file=io.BytesIO(img_data))
             LOG.debug(f"Media: {media}")
 
             if not args['no_caption']:
@@ -242,6 +341,492 @@ def postTwitter(args, paper):
 
     return PostStatus.SUCCESS
 
+POST_FUNCTIONS = {
+    "mastodon": postMastodon,
+    "bluesky":  postBluesky,
+    "twitter":  postTwitter,
+}
+
+## ==============================================
+## postTarget
+## ==============================================
+def postTarget(args, paper, target, started):
+    """
+    Post the paper to a single target once its rate limiter allows it.
+    If the target throttles us, then we back off and try again.
+    """
+    limiter = getLimiter(target)
+    attempt = 0
+    while True:
+        limiter.acquire()
+        started[target] = time.time()
+        try:
+            return POST_FUNCTIONS[target](args, paper)
+        except Exception as ex:
+            if not isRateLimited(ex) or attempt >= POST_RATE_RETRIES:
+                raise
+            incrementCounter("post_throttled_total", target=target)
+            limiter.backoff(attempt)
+            attempt += 1
+            started.pop(target, None)
+    ## WHILE
+## DEF
+
+## ==============================================
+## updateStatus
+## ==============================================
+def updateStatus(args, db, paper, target, status):
+    sql = f"UPDATE papers SET {target} = ? WHERE link = ?"
+    if not args["dry_run"]:
+        assert status is not None
+        LOG.debug(f"{sql} -> {status.value}")
+        cur = db.cursor()
+        cur.execute(sql, (status.value, paper["link"],))
+        if status == PostStatus.SUCCESS:
+            cur.execute("DELETE FROM post_retries WHERE link = ? AND target = ?", (paper["link"], target))
+        db.commit()
+    else:
+        LOG.debug("Not updating %s [%s] because dry-run is enabled", os.path.basename(paper["link"]), target)
+## DEF
+
+## ==============================================
+## getRetryDelay
+## ==============================================
+def getRetryDelay(attempts):
+    """
+    Exponential backoff with jitter so that everything that failed during
+    the same outage does not get retried at the same time.
+    """
+    delay = min(POST_RETRY_MAX_DELAY, POST_RETRY_DELAY * (2 ** (attempts-1)))
+    return random.uniform(delay / 2, delay)
+## DEF
+
+## ==============================================
+## recordFailure
+## ==============================================
+def recordFailure(args, db, paper, target, error, permanent=False):
+    """
+    Remember that we could not post the paper to the target. It stays pending
+    and becomes eligible again after a backoff. Once it has failed
+    POST_MAX_ATTEMPTS times (or right away if the error is permanent, like
+    a bad PDF), it is marked as FAILED and never tried again. That is the
+    dead-letter state: the last error is kept in post_retries.
+    """
+    incrementCounter("post_failures_total", target=target)
+    cur = db.cursor()
+    cur.execute("SELECT attempts FROM post_retries WHERE link = ? AND target = ?", (paper["link"], target))
+    row = cur.fetchone()
+    attempts = (row[0] if row else 0) + 1
+
+    if permanent or attempts >= POST_MAX_ATTEMPTS:
+        next_attempt = None
+        incrementCounter("posts_given_up_total", target=target)
+        LOG.error("Giving up on posting '%s' to %s after %d attempts [%s]", paper["link"], target, attempts, error)
+    else:
+        next_attempt = time.time() + getRetryDelay(attempts)
+        LOG.warning("Retrying '%s' on %s in %d seconds [attempt=%d/%d, error=%s]",
+                    paper["link"], target, next_attempt - time.time(), attempts, POST_MAX_ATTEMPTS, error)
+
+    if args["dry_run"]:
+        LOG.debug("Not recording failure for %s [%s] because dry-run is enabled", os.path.basename(paper["link"]), target)
+        return
+    sql = """INSERT INTO post_retries (
+                link, target, attempts, last_error, next_attempt, updated
+            ) VALUES (
+                ?, ?, ?, ?, ?, CURRENT_TIMESTAMP)
+            ON CONFLICT(link, target) DO UPDATE SET
+                attempts = excluded.attempts,
+                last_error = excluded.last_error,
+                next_attempt = excluded.next_attempt,
+                updated = excluded.updated"""
+    cur.execute(sql, (paper["link"], target, attempts, str(error), next_attempt))
+    if next_attempt is None:
+        updateStatus(args, db, paper, target, PostStatus.FAILED)
+    else:
+        db.commit()
+## DEF
+
+## ==============================================
+## recordUnknown
+## ==============================================
+def recordUnknown(args, db, paper, target, future):
+    """
+    We gave up waiting on a post, but its thread is still running and the post
+    might still go through. Retrying it now could post the paper twice, so it is
+    marked as UNKNOWN instead until resolvePosts() finds out how it ended.
+    """
+    incrementCounter("posts_unknown_total", target=target)
+    UNRESOLVED.append((paper, target, future))
+    if not args["dry_run"]:
+        db.execute("""INSERT INTO post_retries (link, target, last_error, updated)
+                      VALUES (?, ?, ?, CURRENT_TIMESTAMP)
+                      ON CONFLICT(link, target) DO UPDATE SET
+                          last_error = excluded.last_error,
+                          next_attempt = NULL,
+                          updated = excluded.updated""",
+                   (paper["link"], target, "Timed out after %d seconds" % POST_TIMEOUT[target]))
+    updateStatus(args, db, paper, target, PostStatus.UNKNOWN)
+## DEF
+
+## ==============================================
+## resolvePosts
+## ==============================================
+def resolvePosts(args, db, timeout=0):
+    """
+    Check on the posts that timed out, waiting up to the given number of seconds
+    for them to finish. The ones that finished after all are marked as posted,
+    and the ones that failed go into the retry queue. Posts that are still
+    running after that stay UNKNOWN for someone to check by hand.
+    """
+    if timeout and UNRESOLVED:
+        LOG.info("Waiting up to %d seconds for %d posts that timed out", timeout, len(UNRESOLVED))
+        wait([ future for paper, target, future in UNRESOLVED ], timeout=timeout)
+    for item in list(UNRESOLVED):
+        paper, target, future = item
+        if not future.done():
+            continue
+        UNRESOLVED.remove(item)
+        try:
+            status = future.result()
+        except Exception as ex:
+            LOG.warning("Post of '%s' to %s that timed out has failed [%s]", paper["link"], target, ex)
+            updateStatus(args, db, paper, target, PostStatus.PENDING)
+            recordFailure(args, db, paper, target, "%s: %s" % (type(ex).__name__, ex))
+            continue
+        LOG.info("Post of '%s' to %s that timed out went through after all", paper["link"], target)
+        incrementCounter("posts_sent_total", target=target)
+        updateStatus(args, db, paper, target, status)
+    ## FOR
+## DEF
+
+## ==============================================
+## getRetryTimes
+## ==============================================
+def getRetryTimes(db):
+    """Return a dict of (link, target) -> the earliest time that we can try posting it again"""
+    cur = db.cursor()
+    retries = { }
+    for row in cur.execute("SELECT link, target, next_attempt FROM post_retries WHERE next_attempt IS NOT NULL"):
+        retries[(row[0], row[1])] = row[2]
+    return retries
+## DEF
+
+## ==============================================
+## postPaper
+## ==============================================
+def postPaper(args, db, paper, targets):
+    """
+    Post the paper to all of the given targets at the same time.
+    Each target's status is written to the database as soon as it finishes.
+    If a target raises an error or does not finish within its POST_TIMEOUT,
+    then it goes into the retry queue without holding up the other targets.
+    The timeout only starts once the target's rate limiter lets it go.
+    """
+    pool = ThreadPoolExecutor(max_workers=len(targets))
+    started = { }
+    pending = { pool.submit(postTarget, args, paper, target, started): target for target in targets }
+    try:
+        while pending:
+            deadlines = { }
+            for f, target in pending.items():
+                deadlines[f] = started[target] + POST_TIMEOUT[target] if target in started else float("inf")
+            wake_at = min(list(deadlines.values()) + [ time.time() + 1 ])
+            done, not_done = wait(pending.keys(), timeout=max(0, wake_at - time.time()),
+                                  return_when=FIRST_COMPLETED)
+            for f in done:
+                target = pending.pop(f)
+                try:
+                    status = f.result()
+                except Exception as ex:
+                    LOG.exception("Failed to post '%s' to %s", paper["link"], target)
+                    recordFailure(args, db, paper, target, "%s: %s" % (type(ex).__name__, ex))
+                    continue
+                incrementCounter("posts_sent_total", target=target)
+                updateStatus(args, db, paper, target, status)
+            ## FOR
+            for f in not_done:
+                if time.time() >= deadlines[f]:
+                    target = pending.pop(f)
+                    LOG.error("Timed out after %d seconds posting '%s' to %s", POST_TIMEOUT[target], paper["link"], target)
+                    recordUnknown(args, db, paper, target, f)
+            ## FOR
+        ## WHILE
+    finally:
+        # Do not hold up the next paper for a post that timed out. Its thread
+        # is bounded by POST_REQUEST_TIMEOUT, and main() waits for it before
+        # we exit (the interpreter would join it at exit anyway).
+        pool.shutdown(wait=False)
+## DEF
+
+## ==============================================
+## Prefetcher
+## ==============================================
+class Prefetcher:
+    """
+    Download and render the thumbnails for the next papers in the queue in the
+    background so that posting a paper only has to upload its image. If a
+    paper has a bad PDF, then we find out (and mark it as failed) before its
+    turn comes up.
+    """
+    def __init__(self, args, db, targets):
+        self.args = args
+        self.db = db
+        self.targets = targets
+        self.count = args["prefetch"] if not args["no_image"] else 0
+        self.pool = ThreadPoolExecutor(max_workers=PREFETCH_JOBS) if self.count > 0 else None
+        self.futures = { }
+        self.failed = set()
+
+    def _pendingTargets(self, paper):
+        return [ t for t in self.targets if paper[t] == PostStatus.PENDING.value ]
+
+    def submit(self, papers):
+        """Start rendering thumbnails for the first 'count' papers in the given list"""
+        if self.pool is None:
+            return
+        papers = [ p for p in papers if not p["link"] in self.failed ]
+        for paper in papers[:self.count]:
+            if paper["link"] in self.futures:
+                continue
+            LOG.debug("Prefetching thumbnail for '%s'", paper["link"])
+            width = getImageWidth(self._pendingTargets(paper))
+            self.futures[paper["link"]] = (self.pool.submit(getImage, paper["link"], width), paper)
+        ## FOR
+
+    def get(self, paper):
+        """Return the thumbnail for the paper, waiting for it if it is still being prefetched"""
+        entry = self.futures.pop(paper["link"], None)
+        if entry is not None:
+            return entry[0].result()
+        return getImage(paper["link"], getImageWidth(self._pendingTargets(paper)))
+
+    def reap(self):
+        """Mark any paper whose thumbnail could not be created as failed right away"""
+        for link, (f, paper) in list(self.futures.items()):
+            if not f.done() or not isinstance(f.exception(), (PDFPageCountError, InvalidFileError)):
+                continue
+            LOG.error("Failed to generate image for %s [%s]", link, f.exception())
+            for target in self._pendingTargets(paper):
+                recordFailure(self.args, self.db, paper, target, repr(f.exception()), permanent=True)
+            self.failed.add(link)
+            del self.futures[link]
+        ## FOR
+
+    def shutdown(self):
+        if self.pool is not None:
+            self.pool.shutdown(wait=False, cancel_futures=True)
+## CLASS
+
+## ==============================================
+## getPendingPapers
+## ==============================================
+def getPendingPapers(args, db, targets):
+    """Return the papers that still need to be posted to at least one target"""
+    assert len(targets)
+    columns = [ "link", "title", "authors", "volume", "number", "published" ] + targets
+    sql = "SELECT %s FROM papers WHERE %s " % (", ".join(columns), getPendingWhere(targets))
+    sql += "ORDER BY volume ASC, number ASC, "
+    params = ( )
+    if 'preference' in args and args['preference']:
+        # Look up the preferred author's papers in the full-text index
+        sql += """CASE WHEN id IN (
+                      SELECT rowid FROM papers_fts WHERE papers_fts MATCH ?
+                  ) THEN NULL ELSE link END DESC"""
+        params = ( getMatchPhrase(args['preference'], "authors"), )
+    else:
+        sql += "link"
+    LOG.debug("%s %s", sql, params)
+
+    cur = db.cursor()
+    papers = [ ]
+    for row in cur.execute(sql, params):
+        papers.append(dict(zip(columns, row)))
+    ## FOR
+    return papers
+## DEF
+
+## ==============================================
+## announcePaper
+## ==============================================
+def announcePaper(args, db, paper, targets, prefetcher):
+    error = None
+    permanent = False
+
+    # Get a thumbnail of the first page that is big enough for all of the targets
+    if not args['no_image']:
+        # We have been getting invalid PDFs that block the rest of the queue
+        # If we get an error when trying to convert the image, just mark it as failed
+        try:
+            paper["image"] = prefetcher.get(paper)
+            assert paper["image"]
+        except (PDFPageCountError, InvalidFileError) as ex:
+            LOG.error("Failed to generate image for " + paper["link"])
+            error = repr(ex)
+            permanent = True
+        except Exception as ex:
+            # Most likely we could not download the PDF, so try again later
+            LOG.exception("Failed to get image for '%s'", paper["link"])
+            error = "%s: %s" % (type(ex).__name__, ex)
+    else:
+        paper["image"] = ""
+
+    if error is None:
+        postPaper(args, db, paper, targets)
+    else:
+        for target in targets:
+            recordFailure(args, db, paper, target, error, permanent)
+## DEF
+
+## ==============================================
+## schedulePapers
+## ==============================================
+def schedulePapers(args, db, papers, targets):
+    """
+    Give every pending paper/target pair that does not have a slot yet one
+    that is 'sleep' seconds after the last slot for that target.
+    Returns a dict of (link, target) -> scheduled_at for all of the slots.
+    """
+    cur = db.cursor()
+    schedule = { }
+    for row in cur.execute("SELECT link, target, scheduled_at FROM schedule"):
+        schedule[(row[0], row[1])] = row[2]
+
+    now = time.time()
+    rows = [ ]
+    for target in targets:
+        cur.execute("SELECT MAX(scheduled_at) FROM schedule WHERE target = ?", (target,))
+        last = cur.fetchone()[0]
+        next_at = now if last is None else max(now, last + args["sleep"])
+        for paper in papers:
+            key = (paper["link"], target)
+            if paper[target] != PostStatus.PENDING.value or key in schedule:
+                continue
+            schedule[key] = next_at
+            rows.append((paper["link"], target, next_at))
+            next_at += args["sleep"]
+        ## FOR
+    ## FOR
+    if rows:
+        LOG.debug("Scheduling %d new posts", len(rows))
+        cur.executemany("INSERT INTO schedule (link, target, scheduled_at) VALUES (?, ?, ?)", rows)
+        db.commit()
+    return schedule
+## DEF
+
+## ==============================================
+## shiftSchedule
+## ==============================================
+def shiftSchedule(args, db, target, link, not_before):
+    """
+    Push back the remaining slots for the target so that the next one is not
+    before the given time. This keeps the spacing between posts if we have
+    fallen behind (e.g., the process was not running for a while).
+    """
+    where = f"target = ? AND link != ? AND link IN (SELECT link FROM papers WHERE {target} = {PostStatus.PENDING.value})"
+    cur = db.cursor()
+    cur.execute("SELECT MIN(scheduled_at) FROM schedule WHERE " + where, (target, link))
+    next_at = cur.fetchone()[0]
+    if next_at is None or next_at >= not_before:
+        return
+    LOG.debug("Shifting remaining %s posts by %d seconds", target, not_before - next_at)
+    cur.execute("UPDATE schedule SET scheduled_at = scheduled_at + ? WHERE " + where, (not_before - next_at, target, link))
+    db.commit()
+## DEF
+
+## ==============================================
+## useTempSchedule
+## ==============================================
+def useTempSchedule(db):
+    """
+    For dry-runs, copy the schedule into a TEMP table with the same name. SQLite
+    looks up unqualified names in the temp schema first, so the scheduler only
+    ever changes this copy. Writing to it does not take the database's write
+    lock, so we never block the collector, and nothing survives the process.
+    """
+    db.execute("""CREATE TEMP TABLE schedule (
+                    link VARCHAR(255) NOT NULL,
+                    target VARCHAR(32) NOT NULL,
+                    scheduled_at REAL NOT NULL,
+                    PRIMARY KEY (link, target)
+                  )""")
+    db.execute("INSERT INTO temp.schedule SELECT link, target, scheduled_at FROM main.schedule")
+    db.commit()
+## DEF
+
+## ==============================================
+## runScheduler
+## ==============================================
+def runScheduler(args, db, targets, prefetcher):
+    """
+    Post papers when their scheduled time comes up. The slots are stored in the
+    database so that a new invocation picks up where the last one left off.
+    Without --daemon we only post whatever is due right now and then return.
+    """
+    if args["dry_run"]:
+        useTempSchedule(db)
+    paper_count = 0
+    posted = set()
+    while True:
+        papers = getPendingPapers(args, db, targets)
+        schedule = schedulePapers(args, db, papers, targets)
+        retries = getRetryTimes(db)
+
+        # Find the first paper in the queue that is due for at least one target
+        now = time.time()
+        due = [ ]
+        upcoming = [ ]
+        for paper in papers:
+            due = [ ]
+            if paper["link"] in prefetcher.failed:
+                continue
+            for target in targets:
+                key = (paper["link"], target)
+                if paper[target] != PostStatus.PENDING.value or key in posted:
+                    continue
+                # A target that is out of tokens waits on its own so that
+                # it does not hold up the other targets in postPaper()
+                due_at = max(schedule[key], retries.get(key, 0), getLimiter(target).readyAt())
+                if due_at <= now:
+                    due.append(target)
+                else:
+                    upcoming.append(due_at)
+            ## FOR
+            if due: break
+        ## FOR
+
+        # Start on the thumbnails for the papers that come up next
+        prefetcher.submit([ p for p in papers if any((p["link"], t) not in posted for t in targets) ])
+
+        if due:
+            LOG.info("Paper '%s' is due for %s", paper["title"], ",".join(due))
+            announcePaper(args, db, paper, due, prefetcher)
+            for target in due:
+                # Failed posts stay pending with a retry time in the database,
+                # except in a dry-run where nothing gets written
+                if args["dry_run"]:
+                    posted.add((paper["link"], target))
+                shiftSchedule(args, db, target, paper["link"], time.time() + args["sleep"])
+            paper_count += 1
+            if args["limit"] and paper_count >= args["limit"]:
+                break
+            continue
+
+        if not args["daemon"]:
+            LOG.info("No more posts are due right now")
+            break
+
+        # Wake up for the next slot, but check for new papers every so often.
+        # The daemon never exits, so update the metrics file while we wait.
+        prefetcher.reap()
+        resolvePosts(args, db)
+        if args["metrics"]:
+            writeMetrics(args["metrics"], "pvldb-post")
+        wake_at = min(upcoming + [ now + SCHEDULE_POLL_TIME ])
+        LOG.warning("Sleeping for %d seconds until the next post...", wake_at - now)
+        sleepFor(wake_at - now, "schedule")
+    ## WHILE
+## DEF
+
 ## ==============================================
 ## main
 ## ==============================================
@@ -254,8 +839,12 @@ if __name__ == '__main__':
     aparser.add_argument('--limit', type=int, help='Number of papers to announce before stopping')
     aparser.add_argument('--no-image', action='store_true', help='Do not post images')
     aparser.add_argument('--no-caption', action='store_true', help='Do not include captions for images')
-    aparser.add_argument('--sleep', type=int, default=POST_SLEEP_TIME, help='How many seconds to sleep between each post')
+    aparser.add_argument('--prefetch', type=int, default=PREFETCH_COUNT, help='Number of upcoming papers to create thumbnails for in the background')
+    aparser.add_argument('--sleep', type=int, default=POST_SLEEP_TIME, help='How many seconds to sleep between each post (0 means only wait for each target\'s rate limit)')
     aparser.add_argument('--preference', type=str, help='Author ordering preference')
+    aparser.add_argument('--scheduler', action='store_true', help='Give each post a slot in the database and only post the ones that are due')
+    aparser.add_argument('--daemon', action='store_true', help='Keep running and wait for the next scheduled post (requires --scheduler)')
+    aparser.add_argument('--metrics', type=str, default=METRICS_FILE, help='Write timers and counters to this file at exit (.prom for Prometheus, otherwise JSON)')
 
     ## Mastodon Parameters
     agroup = aparser.add_argument_group('Mastodon Parameters')
@@ -279,11 +868,13 @@ if __name__ == '__main__':
     agroup.add_argument('--twitter-bearer-token', type=str, help='Twitter Bearer Token')
 
     args = vars(aparser.parse_args())
+    enableMetrics(args["metrics"], "pvldb-post")
 
     ## ----------------------------------------------
     
     if args['debug']:
         LOG.setLevel(logging.DEBUG)
+        logging.getLogger("thumbnails").setLevel(logging.DEBUG)
 
     # If they want to post to a service, make sure they give us all the info
     # that we need to do this
@@ -300,88 +891,49 @@ if __name__ == '__main__':
         post_targets.append(target)
     if not post_targets:
         raise Exception("No post target was specified [%s]", ",".join(all_targets))
+    if args["daemon"] and not args["scheduler"]:
+        LOG.error("'--daemon' requires '--scheduler'")
+        sys.exit(1)
 
     ## ----------------------------------------------
 
-    if not os.path.exists(args['dbpath']):
-        raise Exception("Database file '%s' does not exist" % args['dbpath'])
-    db = sqlite3.connect(args['dbpath'])
+    db = openDatabase(args['dbpath'])
     cur = db.cursor()
 
     ## Post new papers
-
-    where = [ ]
-    for target in post_targets:
-        if target in args and args[target]:
-            where.append(f"{target} = {PostStatus.PENDING.value}")
-    assert len(where)
-
-    sql = "SELECT * FROM papers WHERE %s " % " OR ".join(where)
-    sql += "ORDER BY volume ASC, number ASC, "
-    if 'preference' in args and args['preference']:
-        sql += "CASE WHEN authors LIKE '%" + args['preference'] + "%' THEN NULL ELSE link END DESC"
+    prefetcher = Prefetcher(args, db, post_targets)
+    if args["scheduler"]:
+        runScheduler(args, db, post_targets, prefetcher)
     else:
-        sql += "link"
-    LOG.debug(sql)
-
-    new_papers = [ ]
-    for row in cur.execute(sql):
-        paper = {
-            "link":     row[0],
-            "title":    row[1],
-            "authors":  row[2],
-            "volume":   row[3],
-            "number":   row[4],
-            "published":row[5],
-        }
-        new_papers.append(paper)
-    ## FOR
-    paper_count = 0
-    for paper in new_papers:
-        status = PostStatus.PENDING
-
-        # Get a PNG image of the first page
-        if not args['no_image']:
-            # We have been getting invalid PDFs that block the rest of the queue
-            # If we get an error when trying to convert the image, just mark it as failed
-            try:
-                paper["image"] = getImage(paper["link"])
-                assert paper["image"]
-            except PDFPageCountError:
-                LOG.error("Failed to generate image for " + paper["link"])
-                status = PostStatus.FAILED
-        else:
-            paper["image"] = ""
-
-        for target in post_targets:
-            sql = f"UPDATE papers SET {target} = ? WHERE link = ?"
-            try:
-                if status == PostStatus.PENDING:
-                    if target == "mastodon":
-                        status = postMastodon(args, paper)
-                    elif target == "bluesky":
-                        status = postBluesky(args, paper)
-                    elif target == "twitter":
-                        status = postTwitter(args, paper)
-
-                cur = db.cursor()
-                if not args["dry_run"]:
-                    assert status is not None
-                    LOG.debug(f"{sql} -> {status.value}")
-                    cur.execute(sql, (status.value, paper["link"],))
-                    db.commit()
-                else:
-                    LOG.debug("Not updating %s [%s] because dry-run is enabled", os.path.basename(paper["link"]), target)
-            except:
-                raise
-        paper_count += 1
-        if args["limit"] and paper_count >= args["limit"]:
-            break
-        LOG.warning("Sleeping for %d seconds...", args["sleep"])
-        time.sleep(args["sleep"])
-    ## FOR
-    
-    db.close()
+        paper_count = 0
+        papers = getPendingPapers(args, db, post_targets)
+        retries = getRetryTimes(db)
+        for i, paper in enumerate(papers):
+            if paper["link"] in prefetcher.failed:
+                continue
+            targets = [ t for t in post_targets if paper[t] == PostStatus.PENDING.value and \
+                                                   retries.get((paper["link"], t), 0) <= time.time() and \
+                                                   getLimiter(t).readyAt() <= time.time() ]
+            if not targets:
+                LOG.debug("Waiting to retry '%s' or for the rate limits", paper["link"])
+                continue
+            prefetcher.submit(papers[i:])
+            announcePaper(args, db, paper, targets, prefetcher)
+            paper_count += 1
+            if args["limit"] and paper_count >= args["limit"]:
+                break
+            prefetcher.reap()
+            resolvePosts(args, db)
+            if args["sleep"] > 0:
+                LOG.warning("Sleeping for %d seconds...", args["sleep"])
+                sleepFor(args["sleep"], "post_interval")
+        ## FOR
+    prefetcher.shutdown()
+    resolvePosts(args, db, timeout=max(POST_TIMEOUT[t] for t in post_targets))
+    for paper, target, future in UNRESOLVED:
+        LOG.error("Do not know whether '%s' was posted to %s. Check and reset its status by hand", paper["link"], target)
+
+    closeDatabase(db)
 ## MAIN
     
     
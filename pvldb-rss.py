@@ -3,12 +3,27 @@
 
 import os
 import sys
+import json
+import hashlib
+import tempfile
 import logging
 import argparse
-import sqlite3
+import zlib
+import dateutil.parser
+from datetime import datetime, timezone
+from xml.sax import saxutils
 from feedgen.feed import FeedGenerator
+from feedgen.ext.base import BaseExtension
+from feedgen.util import xml_elem
 
 from config import *
+from database import openDatabase, closeDatabase
+from metrics import enableMetrics, incrementCounter, timed
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
 
 ## ==============================================
 ## LOGGING
@@ -21,40 +36,450 @@ LOG_handler.setFormatter(LOG_formatter)
 LOG.addHandler(LOG_handler)
 LOG.setLevel(logging.INFO)
 
+ATOM_NS = "http://www.w3.org/2005/Atom"
+HISTORY_NS = "http://purl.org/syndication/history/1.0"
+
+PAPER_COLUMNS = "link, title, authors, volume, number, published, created"
+
 ## ==============================================
-## writeRSS
+## HistoryExtension
+## ==============================================
+class HistoryExtension(BaseExtension):
+    """
+    Feed paging and archiving from RFC 5005. feedgen only writes the 'self'
+    link into RSS feeds, so we add the archive links ourselves for both formats.
+    """
+    def __init__(self):
+        self.links = [ ]
+        self.archive = False
+
+    def extend_ns(self):
+        return { "fh": HISTORY_NS }
+
+    def extend_atom(self, feed):
+        # feedgen writes the ATOM elements without a namespace prefix
+        for rel, href in self.links:
+            xml_elem("link", feed, href=href, rel=rel)
+        if self.archive:
+            xml_elem("{%s}archive" % HISTORY_NS, feed)
+        return feed
+
+    def extend_rss(self, feed):
+        channel = feed[0]
+        for rel, href in self.links:
+            xml_elem("{%s}link" % ATOM_NS, channel, href=href, rel=rel)
+        if self.archive:
+            xml_elem("{%s}archive" % HISTORY_NS, channel)
+        return feed
+## CLASS
+
+## ==============================================
+## writeFile
+## ==============================================
+def writeFile(path, data):
+    """
+    Write the file atomically so that nobody ever sees a partial feed.
+    The data is either a bytes object or an iterable of bytes chunks.
+    The existing file is left alone if it already has the same contents so
+    that its mtime (and the web server's Last-Modified) does not change.
+    Returns a tuple of whether the file changed and its sha256 digest.
+    """
+    if isinstance(data, bytes):
+        data = [ data ]
+    checksum = hashlib.sha256()
+    fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix=".tmp-" + os.path.basename(path))
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            for chunk in data:
+                checksum.update(chunk)
+                f.write(chunk)
+        digest = checksum.hexdigest()
+        if os.path.exists(path) and os.path.getsize(path) == os.path.getsize(temp_path) \
+           and hashFile(path) == digest:
+            os.remove(temp_path)
+            return (False, digest)
+        os.chmod(temp_path, 0o644)
+        os.replace(temp_path, path)
+    except:
+        os.remove(temp_path)
+        raise
+    return (True, digest)
+## DEF
+
+## ==============================================
+## hashFile
+## ==============================================
+def hashFile(path):
+    checksum = hashlib.sha256()
+    with open(path, 'rb') as fd:
+        for chunk in iter(lambda: fd.read(65536), b""):
+            checksum.update(chunk)
+    return checksum.hexdigest()
+## DEF
+
+## ==============================================
+## compressFile
+## ==============================================
+def compressFile(path, compress, flush):
+    with open(path, 'rb') as fd:
+        for chunk in iter(lambda: fd.read(65536), b""):
+            yield compress(chunk)
+    yield flush()
+## DEF
+
+## ==============================================
+## getCompressors
+## ==============================================
+def getCompressors():
+    """
+    Return the file extensions and (compress, flush) functions for the
+    precompressed copies. The gzip header has no timestamp so that the
+    output only depends on the input.
+    """
+    gz = zlib.compressobj(9, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    compressors = [ (".gz", gz.compress, gz.flush) ]
+    if brotli is not None:
+        br = brotli.Compressor(quality=11)
+        compressors.append((".br", br.process, br.finish))
+    return compressors
+## DEF
+
+## ==============================================
+## publishFile
+## ==============================================
+def publishFile(path, data, compress=False):
+    """
+    Write a feed file along with its ETag sidecar and, if compress is set,
+    the precompressed .gz/.br copies for the web server to serve as-is.
+    Nothing is replaced if the feed's contents did not change.
+    """
+    changed, digest = writeFile(path, data)
+    writeFile(path + ".etag", ('"%s"\n' % digest[:32]).encode("utf-8"))
+
+    extensions = [ ".gz", ".br" ]
+    if compress:
+        for ext, compress_func, flush_func in getCompressors():
+            extensions.remove(ext)
+            if changed or not os.path.exists(path + ext):
+                writeFile(path + ext, compressFile(path, compress_func, flush_func))
+        ## FOR
+        if brotli is None:
+            LOG.debug("The brotli module is not installed. Skipping '%s.br'", path)
+    # Don't leave behind stale copies that the web server might still serve
+    for ext in extensions:
+        if os.path.exists(path + ext):
+            os.remove(path + ext)
+    ## FOR
+
+    incrementCounter("feed_files_total", status="changed" if changed else "unchanged")
+    if changed:
+        LOG.info("Created '%s' [etag=%s]" % (path, digest[:32]))
+    else:
+        LOG.debug("Feed '%s' has not changed" % path)
+    return changed
+## DEF
+
+## ==============================================
+## getFingerprint
+## ==============================================
+def getFingerprint(db, window, archive_size, compress=False):
+    """
+    Return a string that changes whenever papers are added to the database
+    or when the feed configuration changes.
+    """
+    cur = db.cursor()
+    cur.execute("SELECT COUNT(*), MAX(id), MAX(created) FROM papers")
+    state = list(cur.fetchone()) + [ FEED_BASE_URL, RSS_TITLE, RSS_SUBTITLE, RSS_AUTHOR,
+                                     RSS_FILE, ATOM_FILE, window, archive_size, compress ]
+    return hashlib.sha256(json.dumps(state).encode("utf-8")).hexdigest()
+## DEF
+
+## ==============================================
+## getArchiveFile
+## ==============================================
+def getArchiveFile(filename, page):
+    """Return the file name of the archive page for the given feed file"""
+    base, ext = os.path.splitext(filename)
+    return "%s-%04d%s" % (base, page, ext)
+## DEF
+
+## ==============================================
+## getWindowQuery
+## ==============================================
+# The order that the papers were collected in. Papers from the same run have
+# the same 'created' time, so those are ordered by their volume and number.
+# This matches the papers_collected index.
+COLLECTED_ORDER = "created %s, volume %s, number %s, link %s"
+
+def getWindowQuery(size):
+    """Return the query for the most recently collected papers"""
+    sql = "SELECT %s FROM papers ORDER BY %s LIMIT ?" % (PAPER_COLUMNS, COLLECTED_ORDER % (("DESC",) * 4))
+    return (sql, (size,))
+## DEF
+
+## ==============================================
+## getArchiveQuery
+## ==============================================
+def getArchiveQuery(page, size):
+    """
+    Return the query for the papers in the given archive page. Pages are
+    filled in the order that the papers were collected so a full page never changes.
+    """
+    sql = "SELECT %s FROM papers ORDER BY %s LIMIT ? OFFSET ?" % (PAPER_COLUMNS, COLLECTED_ORDER % (("ASC",) * 4))
+    return (sql, (size, (page-1) * size))
+## DEF
+
+## ==============================================
+## getPapers
+## ==============================================
+def getPapers(db, query, order="ASC"):
+    """Yield the papers for one of the queries above one row at a time"""
+    sql = "SELECT * FROM (%s) ORDER BY volume %s, number %s, link %s" % (query[0], order, order, order)
+    for row in db.cursor().execute(sql, query[1]):
+        paper = {
+            "link":     row[0],
+            "title":    row[1],
+            "authors":  row[2],
+            "volume":   row[3],
+            "number":   row[4],
+            "published":row[5],
+            "created":  row[6],
+        }
+        yield paper
+    ## FOR
+## DEF
+
+## ==============================================
+## getUpdated
 ## ==============================================
-def writeRSS(papers, output):
+def getUpdated(paper):
+    """
+    Return when the paper was added to the database. This is used instead
+    of the current time so that the feeds only change when their papers do.
+    """
+    if paper["created"] is None:
+        return parseDate(paper["published"])
+    return datetime.fromisoformat(paper["created"]).replace(tzinfo=timezone.utc)
+## DEF
+
+## ==============================================
+## getFeedUpdated
+## ==============================================
+def getFeedUpdated(db, query):
+    """Return the time that the newest paper in the query was added"""
+    sql = "SELECT MAX(created) FROM (%s)" % query[0]
+    created = db.cursor().execute(sql, query[1]).fetchone()[0]
+    if created is None:
+        return datetime.now(timezone.utc)
+    return datetime.fromisoformat(created).replace(tzinfo=timezone.utc)
+## DEF
+
+## ==============================================
+## createFeed
+## ==============================================
+def createFeed(updated):
+    """Create a FeedGenerator with all of the feed-level fields but no entries"""
     fg = FeedGenerator()
-    fg.id(RSS_URL)
+    fg.register_extension("history", HistoryExtension, atom=True, rss=True)
     fg.title(RSS_TITLE)
     fg.subtitle(RSS_SUBTITLE)
     fg.author(RSS_AUTHOR)
     fg.link( href='https://www.vldb.org/pvldb/', rel='alternate' )
     fg.language('en')
-    
-    for p in papers:
+    fg.updated(updated)
+    return fg
+## DEF
+
+## ==============================================
+## setFeedLinks
+## ==============================================
+def setFeedLinks(fg, filename, page, num_pages):
+    """
+    Point the feed's id and RFC 5005 links at the documents for the given
+    format. If page is set then this is an archive page, otherwise it is the
+    main feed. num_pages is the number of complete archive pages that exist.
+    Returns the name of the file to write.
+    """
+    links = [ ]
+    if page is None:
+        fg.id(RSS_URL)
+        fg.history.archive = False
+        links.append(("self", FEED_BASE_URL + filename))
+        if num_pages > 0:
+            links.append(("prev-archive", FEED_BASE_URL + getArchiveFile(filename, num_pages)))
+    else:
+        fg.id(FEED_BASE_URL + getArchiveFile(RSS_FILE, page))
+        fg.history.archive = True
+        links.append(("self", FEED_BASE_URL + getArchiveFile(filename, page)))
+        links.append(("current", FEED_BASE_URL + filename))
+        if page > 1:
+            links.append(("prev-archive", FEED_BASE_URL + getArchiveFile(filename, page-1)))
+        if page < num_pages:
+            links.append(("next-archive", FEED_BASE_URL + getArchiveFile(filename, page+1)))
+        filename = getArchiveFile(filename, page)
+    fg.history.links = links
+    return filename
+## DEF
+
+## ==============================================
+## writeRSS
+## ==============================================
+@timed("feed_write_seconds", backend="feedgen")
+def writeRSS(db, query, output, page=None, num_pages=0, compress=False):
+    """Write the ATOM and RSS feeds for the papers in the query using feedgen"""
+    fg = createFeed(getFeedUpdated(db, query))
+    for p in getPapers(db, query):
         summary = "%(title)s\nAuthors: %(authors)s\n[PVLDB Volume %(volume)d, Number %(number)d]" % p
-        
+
         fe = fg.add_entry()
         fe.author(name=p["authors"])
         fe.title(p["title"])
-        fe.link(href=p["link"]) 
+        fe.link(href=p["link"])
         fe.id(p["link"])
         fe.published(published=p["published"])
+        fe.updated(getUpdated(p))
         # fe.description(description=summary, isSummary=True)
         fe.content(summary)
     ## FOR
-    
-    atomfeed = fg.atom_str(pretty=True) # Get the ATOM feed as string
-    atom_file = os.path.join(output, 'pvldb-atom.xml')
-    fg.atom_file(atom_file) # Write the ATOM feed to a file
-    LOG.info("Created ATOM '%s'" % atom_file)
-    
-    rssfeed  = fg.rss_str(pretty=True) # Get the RSS feed as string
-    rss_file = os.path.join(output, RSS_FILE)
-    fg.rss_file(rss_file) # Write the RSS feed to a file
-    LOG.info("Created RSS '%s'" % rss_file)
+
+    for filename, render in ((ATOM_FILE, fg.atom_str), (RSS_FILE, fg.rss_str)):
+        path = os.path.join(output, setFeedLinks(fg, filename, page, num_pages))
+        publishFile(path, render(pretty=True), compress)
+    ## FOR
+## DEF
+
+## ==============================================
+## Streaming Feed Writer
+## ==============================================
+# These produce the same bytes that lxml writes for the entries that
+# writeRSS() creates with feedgen, without building any element trees.
+# feedgen prepends every entry, so the papers are read in reverse order.
+
+WEEKDAYS = ( "Mon", "Tue", "Wed", "Thu", "Fri", "Sat", "Sun" )
+MONTHS = ( "Jan", "Feb", "Mar", "Apr", "May", "Jun", "Jul", "Aug", "Sep", "Oct", "Nov", "Dec" )
+
+ATOM_ENTRY = """  <entry>
+    <id>%(link)s</id>
+    <title>%(title)s</title>
+    <updated>%(updated)s</updated>
+%(author)s    <content>%(summary)s</content>
+    <link href="%(href)s" rel="alternate"/>
+    <published>%(published)s</published>
+  </entry>
+"""
+ATOM_AUTHOR = """    <author>
+      <name>%s</name>
+    </author>
+"""
+RSS_ITEM = """    <item>
+      <title>%(title)s</title>
+      <link>%(link)s</link>
+      <description>%(summary)s</description>
+      <guid isPermaLink="false">%(link)s</guid>
+      <pubDate>%(pubdate)s</pubDate>
+    </item>
+"""
+
+def escapeText(text):
+    return saxutils.escape(text, { "\r": "&#13;" })
+
+def escapeAttr(text):
+    return saxutils.escape(text, { '"': "&quot;", "\n": "&#10;", "\r": "&#13;", "\t": "&#9;" })
+
+def parseDate(date):
+    try:
+        date = datetime.fromisoformat(date)
+    except ValueError:
+        date = dateutil.parser.parse(date)
+    if date.tzinfo is None:
+        raise ValueError("Datetime object has no timezone info")
+    return date
+
+def formatRFC2822(date):
+    # Same as feedgen.util.formatRFC2822 but without switching the locale for every entry
+    return "%s, %02d %s %d %s" % (WEEKDAYS[date.weekday()], date.day, MONTHS[date.month-1],
+                                  date.year, date.strftime("%H:%M:%S %z"))
+
+def formatAtomEntry(p):
+    summary = "%(title)s\nAuthors: %(authors)s\n[PVLDB Volume %(volume)d, Number %(number)d]" % p
+    return ATOM_ENTRY % {
+        "link":      escapeText(p["link"]),
+        "href":      escapeAttr(p["link"]),
+        "title":     escapeText(p["title"]),
+        "updated":   getUpdated(p).isoformat(),
+        "author":    ATOM_AUTHOR % escapeText(p["authors"]) if p["authors"] else "",
+        "summary":   escapeText(summary),
+        "published": parseDate(p["published"]).isoformat(),
+    }
+
+def formatRssItem(p):
+    summary = "%(title)s\nAuthors: %(authors)s\n[PVLDB Volume %(volume)d, Number %(number)d]" % p
+    return RSS_ITEM % {
+        "link":      escapeText(p["link"]),
+        "title":     escapeText(p["title"]),
+        "summary":   escapeText(summary),
+        "pubdate":   formatRFC2822(parseDate(p["published"])),
+    }
+
+def streamEntries(header, footer, papers, formatter):
+    yield header
+    for p in papers:
+        yield formatter(p).encode("utf-8")
+    yield footer
+
+## ==============================================
+## streamRSS
+## ==============================================
+@timed("feed_write_seconds", backend="stream")
+def streamRSS(db, query, output, page=None, num_pages=0, compress=False):
+    """
+    Write the ATOM and RSS feeds for the papers in the query straight from
+    the database cursor. feedgen is only used to render the feed-level
+    elements, so memory stays constant no matter how many papers there are.
+    """
+    fg = createFeed(getFeedUpdated(db, query))
+    formats = (
+        (ATOM_FILE, fg.atom_str, formatAtomEntry, b"</feed>"),
+        (RSS_FILE,  fg.rss_str,  formatRssItem,   b"  </channel>"),
+    )
+    for filename, render, formatter, close_tag in formats:
+        path = os.path.join(output, setFeedLinks(fg, filename, page, num_pages))
+        header, footer = render(pretty=True).rsplit(close_tag, 1)
+        papers = getPapers(db, query, order="DESC")
+        publishFile(path, streamEntries(header, close_tag + footer, papers, formatter), compress)
+    ## FOR
+## DEF
+
+FEED_WRITERS = {
+    "feedgen":  writeRSS,
+    "stream":   streamRSS,
+}
+
+## ==============================================
+## writeArchives
+## ==============================================
+def writeArchives(db, output, writer, state, num_pages, archive_size, force=False, compress=False):
+    """
+    Write the archive pages that are new or missing. A page only has to
+    be rewritten when the page after it gets created so that it can link
+    to it with 'next-archive'. Returns the number of pages written.
+    """
+    last_page = state.get("archives", 0)
+    # Every page has to be written again to add or remove the compressed copies
+    if state.get("archive_size") != archive_size or state.get("compress", False) != compress:
+        force = True
+
+    num_written = 0
+    for page in range(1, num_pages+1):
+        exists = all(os.path.exists(os.path.join(output, getArchiveFile(f, page))) for f in (ATOM_FILE, RSS_FILE))
+        if not force and exists and page < last_page:
+            continue
+        if not force and exists and page == last_page and page == num_pages:
+            continue
+        writer(db, getArchiveQuery(page, archive_size), output, page, num_pages, compress)
+        num_written += 1
+    ## FOR
+    return num_written
 ## DEF
 
 ## ==============================================
@@ -65,43 +490,68 @@ if __name__ == '__main__':
     aparser.add_argument('dbpath', type=str, help='Database Path')
     aparser.add_argument('rsspath', type=str, help='RSS output directory')
     aparser.add_argument("--debug", action='store_true')
+    aparser.add_argument("--force", action='store_true', help='Regenerate the feeds even if there are no new papers')
+    aparser.add_argument("--window", type=int, default=FEED_WINDOW, help='Number of recent papers in the main feeds')
+    aparser.add_argument("--archive-size", type=int, default=FEED_ARCHIVE_SIZE, help='Number of papers per archive page')
+    aparser.add_argument("--backend", choices=FEED_WRITERS.keys(), default=FEED_BACKEND,
+                         help='Build the feeds with feedgen or stream them straight from the database')
+    aparser.add_argument("--compress", action='store_true', default=FEED_COMPRESS,
+                         help='Also write precompressed .gz (and .br if brotli is installed) copies of the feeds')
+    aparser.add_argument('--metrics', type=str, default=METRICS_FILE, help='Write timers and counters to this file at exit (.prom for Prometheus, otherwise JSON)')
 
     args = vars(aparser.parse_args())
+    enableMetrics(args["metrics"], "pvldb-rss")
 
     ## ----------------------------------------------
-    
+
     if args['debug']:
         LOG.setLevel(logging.DEBUG)
 
     ## ----------------------------------------------
-    
-    if not os.path.exists(args['dbpath']):
-        raise Exception("Database file %s does not exist", args['dbpath'])
-    db = sqlite3.connect(args['dbpath'])
+
+    if args["window"] <= 0 or args["archive_size"] <= 0:
+        raise Exception("The feed window and archive size must be greater than zero")
+    db = openDatabase(args['dbpath'])
     cur = db.cursor()
-        
-    # Always create the RSS files from scratch
+
+    # Only create the RSS files if something changed since the last time
     assert args["rsspath"]
     if not os.path.exists(args["rsspath"]):
         os.makedirs(args["rsspath"])
 
-    sql = "SELECT link, title, authors, volume, number, published FROM papers ORDER BY volume ASC, number ASC, link"
-    papers = [ ]
-    for row in cur.execute(sql):
-        paper = {
-            "link":     row[0],
-            "title":    row[1],
-            "authors":  row[2],
-            "volume":   row[3],
-            "number":   row[4],
-            "published":row[5],
-        }
-        papers.append(paper)
-    ## FOR
-    writeRSS(papers, args["rsspath"])
-    
-    db.close()
+    state_file = os.path.join(args["rsspath"], FEED_STATE_FILE)
+    fingerprint = getFingerprint(db, args["window"], args["archive_size"], args["compress"])
+    state = { }
+    if os.path.exists(state_file):
+        with open(state_file, 'r') as fd:
+            state = json.load(fd)
+    if not args["force"] and state.get("fingerprint") == fingerprint and \
+       all(os.path.exists(os.path.join(args["rsspath"], f)) for f in (ATOM_FILE, RSS_FILE)):
+        LOG.info("No new papers since the feeds were last created. Skipping...")
+        closeDatabase(db)
+        sys.exit(0)
+
+    # Every paper that is not in a complete archive page has to be in the
+    # main feed, otherwise subscribers would never see it
+    num_papers = cur.execute("SELECT COUNT(*) FROM papers").fetchone()[0]
+    num_pages = num_papers // args["archive_size"]
+    window = max(args["window"], num_papers - num_pages * args["archive_size"])
+
+    writer = FEED_WRITERS[args["backend"]]
+    num_written = writeArchives(db, args["rsspath"], writer, state, num_pages, args["archive_size"],
+                                args["force"], args["compress"])
+    LOG.debug("Wrote %d of %d archive pages", num_written, num_pages)
+    writer(db, getWindowQuery(window), args["rsspath"], num_pages=num_pages, compress=args["compress"])
+
+    state = {
+        "fingerprint":  fingerprint,
+        "archives":     num_pages,
+        "archive_size": args["archive_size"],
+        "compress":     args["compress"],
+    }
+    writeFile(state_file, json.dumps(state).encode("utf-8"))
+
+    closeDatabase(db)
 ## MAIN
-    
-    
+
 
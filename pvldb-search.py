@@ -0,0 +1,132 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import sys
+import logging
+import argparse
+import sqlite3
+
+from config import *
+from database import openDatabase, closeDatabase, getMatchPhrase
+from metrics import enableMetrics, timer
+
+## ==============================================
+## LOGGING
+## ==============================================
+LOG = logging.getLogger(__name__)
+LOG_handler = logging.StreamHandler()
+LOG_formatter = logging.Formatter(fmt='%(asctime)s [%(funcName)s:%(lineno)03d] %(levelname)-5s: %(message)s',
+                                  datefmt='%m-%d-%Y %H:%M:%S')
+LOG_handler.setFormatter(LOG_formatter)
+LOG.addHandler(LOG_handler)
+LOG.setLevel(logging.INFO)
+
+PAPER_COLUMNS = "papers.link, papers.title, papers.authors, papers.volume, papers.number"
+
+## ==============================================
+## getMatchQuery
+## ==============================================
+def getMatchQuery(text, raw=False):
+    """
+    Return the FTS5 query for the search terms. Unless raw is set, every
+    word has to appear somewhere in the title or the authors.
+    """
+    if raw:
+        return text
+    return " ".join(getMatchPhrase(word) for word in text.split())
+## DEF
+
+## ==============================================
+## searchPapers
+## ==============================================
+def searchPapers(db, query=None, author=None, raw=False, limit=None):
+    """
+    Return the papers that match the full-text query and/or were written
+    by the author. Full-text matches come back best match first, otherwise
+    the newest papers come first.
+    """
+    assert query or author
+    params = [ ]
+    where = [ ]
+    if query:
+        sql = """SELECT %s FROM papers_fts
+                   JOIN papers ON papers.id = papers_fts.rowid""" % PAPER_COLUMNS
+        where.append("papers_fts MATCH ?")
+        params.append(getMatchQuery(query, raw))
+        order_by = "papers_fts.rank"
+    else:
+        sql = "SELECT %s FROM papers" % PAPER_COLUMNS
+        order_by = "papers.volume DESC, papers.number DESC, papers.link"
+    if author:
+        # Author names are unique and case-insensitive, so this is an index lookup
+        where.append("""papers.link IN (
+                            SELECT paper_authors.link FROM authors
+                              JOIN paper_authors ON paper_authors.author_id = authors.id
+                             WHERE authors.name = ?)""")
+        params.append(author)
+    sql += " WHERE " + " AND ".join(where)
+    sql += " ORDER BY " + order_by
+    if limit:
+        sql += " LIMIT ?"
+        params.append(limit)
+    LOG.debug("%s %s", sql, params)
+
+    papers = [ ]
+    for row in db.cursor().execute(sql, params):
+        papers.append({
+            "link":     row[0],
+            "title":    row[1],
+            "authors":  row[2],
+            "volume":   row[3],
+            "number":   row[4],
+        })
+    ## FOR
+    return papers
+## DEF
+
+## ==============================================
+## main
+## ==============================================
+if __name__ == '__main__':
+    aparser = argparse.ArgumentParser(description='PVLDB Paper Search Script')
+    aparser.add_argument('dbpath', help='Database Path')
+    aparser.add_argument('query', nargs='?', help='Words to search for in the titles and authors')
+    aparser.add_argument("--debug", action='store_true')
+
+    aparser.add_argument('--author', type=str, help='Only return papers by this author (full name)')
+    aparser.add_argument('--raw', action='store_true', help='Pass the query to SQLite as FTS5 query syntax')
+    aparser.add_argument('--limit', type=int, default=20, help='Maximum number of papers to return (0 for all)')
+    aparser.add_argument('--metrics', type=str, default=METRICS_FILE, help='Write timers and counters to this file at exit (.prom for Prometheus, otherwise JSON)')
+
+    args = vars(aparser.parse_args())
+    enableMetrics(args["metrics"], "pvldb-search")
+
+    ## ----------------------------------------------
+
+    if args['debug']:
+        LOG.setLevel(logging.DEBUG)
+
+    if not args["query"] and not args["author"]:
+        LOG.error("Either a query or '--author' is required")
+        sys.exit(1)
+
+    ## ----------------------------------------------
+
+    db = openDatabase(args['dbpath'])
+    try:
+        with timer("search_seconds"):
+            papers = searchPapers(db, args["query"], args["author"], args["raw"], args["limit"])
+    except sqlite3.OperationalError as ex:
+        LOG.error("Invalid search query '%s' [%s]", args["query"], ex)
+        sys.exit(1)
+    finally:
+        closeDatabase(db)
+
+    for p in papers:
+        print("Vol:%(volume)d No:%(number)d → %(title)s" % p)
+        if p["authors"]:
+            print("    %(authors)s" % p)
+        print("    %(link)s" % p)
+    ## FOR
+    LOG.debug("Found %d papers", len(papers))
+## MAIN
@@ -0,0 +1,155 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import os
+import sys
+import time
+import logging
+import argparse
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from config import *
+from database import openDatabase, closeDatabase, getPendingWhere, CommitBatcher
+from metrics import enableMetrics, incrementCounter, observeValue
+from thumbnails import getImage, getCachedImage, getPaperImageWidth
+
+## ==============================================
+## LOGGING
+## ==============================================
+LOG = logging.getLogger(__name__)
+LOG_handler = logging.StreamHandler()
+LOG_formatter = logging.Formatter(fmt='%(asctime)s [%(funcName)s:%(lineno)03d] %(levelname)-5s: %(message)s',
+                                  datefmt='%m-%d-%Y %H:%M:%S')
+LOG_handler.setFormatter(LOG_formatter)
+LOG.addHandler(LOG_handler)
+LOG.setLevel(logging.INFO)
+
+## ==============================================
+## getMissingThumbnails
+## ==============================================
+def getMissingThumbnails(args, db):
+    """
+    Return the (link, width) for the papers that do not have a cached thumbnail yet.
+    Unless --width is given, each one is rendered at the width that the poster
+    is going to ask for so that it can actually use it.
+    """
+    cur = db.cursor()
+    targets = args["targets"]
+    sql = """SELECT papers.link, thumbnails.status, %s FROM papers
+              LEFT OUTER JOIN thumbnails ON papers.link = thumbnails.link""" % \
+          ", ".join("papers." + t for t in targets)
+    if not args["all"]:
+        # Only the papers that have not been posted to every target yet
+        sql += " WHERE " + getPendingWhere(targets)
+    sql += " ORDER BY volume DESC, number DESC, papers.link"
+
+    missing = [ ]
+    for row in cur.execute(sql).fetchall():
+        link, status = row[:2]
+        if status == PostStatus.FAILED.value and not args["retry_failed"]:
+            LOG.debug("Skipping '%s' because it failed before", link)
+            continue
+        width = args["width"] or getPaperImageWidth(dict(zip(targets, row[2:])), targets)
+        if getCachedImage(link, width) is None:
+            missing.append((link, width))
+    ## FOR
+    return missing
+## DEF
+
+## ==============================================
+## recordThumbnail
+## ==============================================
+def recordThumbnail(db, link, width, status, error=None):
+    sql = """INSERT OR REPLACE INTO thumbnails (
+                link, width, status, error, updated
+            ) VALUES (
+                ?, ?, ?, ?, CURRENT_TIMESTAMP)"""
+    cur = db.cursor()
+    cur.execute(sql, (link, width, status.value, error))
+## DEF
+
+## ==============================================
+## renderThumbnail
+## ==============================================
+def renderThumbnail(link, width):
+    """
+    Runs in the worker processes, whose metrics never make it back to us.
+    Returns how long getImage() took so that we can record it here instead.
+    """
+    start = time.perf_counter()
+    getImage(link, width)
+    return time.perf_counter() - start
+## DEF
+
+## ==============================================
+## main
+## ==============================================
+if __name__ == '__main__':
+    aparser = argparse.ArgumentParser(description='PVLDB Thumbnail Generation Script')
+    aparser.add_argument('dbpath', help='Database Path')
+    aparser.add_argument("--debug", action='store_true')
+
+    aparser.add_argument('--jobs', type=int, default=os.cpu_count(), help='Number of thumbnails to render in parallel')
+    aparser.add_argument('--width', type=int, help='Thumbnail width in pixels (default: the width that the pending targets need)')
+    aparser.add_argument('--targets', type=str, default=",".join(POST_IMAGE_LIMITS.keys()), help='Comma-separated post targets to render the thumbnails for')
+    aparser.add_argument('--limit', type=int, help='Number of thumbnails to render before stopping')
+    aparser.add_argument('--all', action='store_true', help='Render thumbnails for every paper instead of just the ones that have not been posted yet (CACHE_MAX_SIZE has to be big enough to hold them)')
+    aparser.add_argument('--retry-failed', action='store_true', help='Try again for papers that failed before')
+    aparser.add_argument('--metrics', type=str, default=METRICS_FILE, help='Write timers and counters to this file at exit (.prom for Prometheus, otherwise JSON)')
+
+    args = vars(aparser.parse_args())
+    enableMetrics(args["metrics"], "pvldb-thumbs")
+
+    ## ----------------------------------------------
+
+    if args['debug']:
+        LOG.setLevel(logging.DEBUG)
+        logging.getLogger("thumbnails").setLevel(logging.DEBUG)
+
+    ## ----------------------------------------------
+
+    args["targets"] = args["targets"].split(",")
+    for target in args["targets"]:
+        if target not in POST_IMAGE_LIMITS:
+            LOG.error("Unknown post target '%s'", target)
+            sys.exit(1)
+    db = openDatabase(args['dbpath'])
+
+    links = getMissingThumbnails(args, db)
+    if args["limit"]:
+        links = links[:args["limit"]]
+    LOG.info("Rendering %d missing thumbnails with %d processes", len(links), args["jobs"])
+
+    start = time.time()
+    num_failed = 0
+    batch = CommitBatcher(db)
+    with ProcessPoolExecutor(max_workers=args["jobs"]) as pool:
+        futures = { pool.submit(renderThumbnail, link, width): (link, width) for link, width in links }
+        for i, f in enumerate(as_completed(futures)):
+            link, width = futures[f]
+            try:
+                observeValue("thumbnail_seconds", f.result())
+                incrementCounter("thumbnails_rendered_total")
+                recordThumbnail(db, link, width, PostStatus.SUCCESS)
+            except Exception as ex:
+                LOG.error("Failed to create thumbnail for '%s' [%s]", link, ex)
+                incrementCounter("thumbnail_failures_total")
+                recordThumbnail(db, link, width, PostStatus.FAILED, str(ex))
+                num_failed += 1
+            batch.add()
+
+            elapsed = time.time() - start
+            remaining = elapsed / (i+1) * (len(links) - i - 1)
+            LOG.info("[%d/%d] %s [elapsed=%ds, remaining=%ds]", i+1, len(links), os.path.basename(link), elapsed, remaining)
+        ## FOR
+    LOG.info("Rendered %d thumbnails in %.1f seconds [failed=%d]", len(links) - num_failed, time.time() - start, num_failed)
+
+    # If the cache is too small, then the thumbnails from the start of the run
+    # got evicted to make room for the later ones and we will just redo them next time
+    num_evicted = len([ link for link, width in links if getCachedImage(link, width) is None ]) - num_failed
+    if num_evicted > 0:
+        LOG.warning("%d of the new thumbnails were already evicted from the cache. Increase CACHE_MAX_SIZE", num_evicted)
+
+    batch.commit()
+    closeDatabase(db)
+## MAIN
@@ -0,0 +1,474 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import os
+import io
+import json
+import hashlib
+import time
+import logging
+import threading
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from PIL import Image
+from pdf2image import convert_from_path
+
+from config import *
+from metrics import incrementCounter, sleepFor, timer, timed
+
+## ==============================================
+## LOGGING
+## ==============================================
+LOG = logging.getLogger(__name__)
+LOG_handler = logging.StreamHandler()
+LOG_formatter = logging.Formatter(fmt='%(asctime)s [%(funcName)s:%(lineno)03d] %(levelname)-5s: %(message)s',
+                                  datefmt='%m-%d-%Y %H:%M:%S')
+LOG_handler.setFormatter(LOG_formatter)
+LOG.addHandler(LOG_handler)
+LOG.setLevel(logging.INFO)
+
+# Shared HTTP connection pool for downloading PDFs
+SESSION = None
+
+## ==============================================
+## getImageWidth
+## ==============================================
+def getImageWidth(targets):
+    """Return the width that we need to render the thumbnail at for the given targets"""
+    return max(POST_IMAGE_LIMITS[t][0] for t in targets)
+## DEF
+
+def getPaperImageWidth(paper, targets):
+    """
+    Return the width that the poster will ask for when it posts the paper,
+    which depends on the targets that the paper is still pending for.
+    """
+    pending = [ t for t in targets if paper[t] == PostStatus.PENDING.value ]
+    return getImageWidth(pending or targets)
+## DEF
+
+class InvalidFileError(Exception):
+    """A downloaded PDF or rendered thumbnail is truncated or corrupted"""
+    pass
+
+## ==============================================
+## CACHE
+## ==============================================
+# The cache directory has three parts:
+#   urls/<sha256 of url>.json     -> which PDF a URL points to
+#   pdf/<sha256 of content>.pdf   -> the PDF files
+#   thumbs/<sha256 of pdf>-<width>.jpg
+# We bump the mtime of files whenever we use them and then evict the least
+# recently used PDFs and thumbnails once the whole thing gets bigger than
+# CACHE_MAX_SIZE. Anything used in the last CACHE_MIN_AGE seconds stays, so
+# that we never pull a PDF out from under a render that is about to read it.
+# The url entries are tiny and are needed to find the thumbnails, so we keep them.
+
+# The parts of the cache that we evict from
+EVICTABLE = [ "pdf", "thumbs" ]
+
+def getCachePath(*parts):
+    path = os.path.join(CACHE_DIR, *parts)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    return path
+## DEF
+
+def hashFile(path):
+    sha256 = hashlib.sha256()
+    with open(path, 'rb') as fd:
+        for chunk in iter(lambda: fd.read(DOWNLOAD_CHUNK_SIZE), b""):
+            sha256.update(chunk)
+    return sha256.hexdigest()
+## DEF
+
+def isValidPdf(path, digest=None):
+    """Make sure that the PDF is complete and (optionally) has the given hash"""
+    if not os.path.exists(path) or os.path.getsize(path) < 16:
+        return False
+    with open(path, 'rb') as fd:
+        head = fd.read(5)
+        fd.seek(-min(1024, os.path.getsize(path)), os.SEEK_END)
+        tail = fd.read()
+    if head != b"%PDF-" or tail.find(b"%%EOF") == -1:
+        return False
+    return digest is None or hashFile(path) == digest
+## DEF
+
+def isValidJpeg(path):
+    if not os.path.exists(path) or os.path.getsize(path) < 4:
+        return False
+    with open(path, 'rb') as fd:
+        head = fd.read(2)
+        fd.seek(-2, os.SEEK_END)
+        tail = fd.read(2)
+    return head == b"\xff\xd8" and tail == b"\xff\xd9"
+## DEF
+
+def touch(path):
+    os.utime(path, None)
+## DEF
+
+## ==============================================
+## getSession
+## ==============================================
+def getSession():
+    global SESSION
+    if SESSION is None:
+        retries = Retry(total=DOWNLOAD_RETRIES, backoff_factor=1,
+                        status_forcelist=[ 429, 500, 502, 503, 504 ], allowed_methods=[ "GET" ])
+        adapter = HTTPAdapter(pool_maxsize=DOWNLOAD_POOL_SIZE, max_retries=retries)
+        SESSION = requests.Session()
+        SESSION.mount("http://", adapter)
+        SESSION.mount("https://", adapter)
+    return SESSION
+## DEF
+
+## ==============================================
+## downloadFile
+## ==============================================
+def getValidator(headers):
+    """
+    Return the value to send in If-Range so that a resumed download only gets
+    spliced onto the same version of the file (or None if we cannot tell).
+    Weak ETags are not allowed in If-Range.
+    """
+    etag = headers.get("ETag")
+    if etag and not etag.startswith("W/"):
+        return etag
+    return headers.get("Last-Modified")
+## DEF
+
+def downloadFile(url, path, max_size=DOWNLOAD_MAX_SIZE):
+    """
+    Stream the given URL into a file in chunks. If there is already a partial
+    file there (e.g., from an earlier download that got interrupted), then we
+    ask the server for just the remaining bytes with a Range request. The
+    ETag/Last-Modified of the partial file is kept in '<path>.json' and sent in
+    If-Range so that the server sends the whole file again if it has changed.
+    Returns the size of the file in bytes.
+    """
+    session = getSession()
+    meta_path = path + ".json"
+    for attempt in range(DOWNLOAD_RETRIES + 1):
+        offset = os.path.getsize(path) if os.path.exists(path) else 0
+        # The offsets have to count the bytes of the file itself, so do not let
+        # the server compress the response
+        headers = { "Accept-Encoding": "identity" }
+        if offset:
+            validator = None
+            if os.path.exists(meta_path):
+                with open(meta_path, 'r') as fd:
+                    validator = json.load(fd).get("validator")
+            if validator:
+                headers["Range"] = "bytes=%d-" % offset
+                headers["If-Range"] = validator
+            else:
+                LOG.debug("Cannot tell which version the partial download of '%s' is. Restarting download", url)
+                offset = 0
+        received = 0
+        try:
+            with session.get(url, headers=headers, stream=True, timeout=DOWNLOAD_TIMEOUT) as response:
+                if offset and response.status_code == 416:
+                    LOG.debug("Server rejected Range request for '%s'. Restarting download", url)
+                    os.remove(path)
+                    continue
+                response.raise_for_status()
+                if offset and response.status_code != 206:
+                    LOG.debug("Server ignored Range request or the file changed for '%s'. Restarting download", url)
+                    offset = 0
+                if not offset:
+                    with open(meta_path, 'w') as fd:
+                        json.dump({"url": url, "validator": getValidator(response.headers)}, fd)
+
+                expected = None
+                if "Content-Length" in response.headers:
+                    expected = offset + int(response.headers["Content-Length"])
+                    if expected > max_size:
+                        raise InvalidFileError("'%s' is too big [%d bytes]" % (url, expected))
+
+                with open(path, 'ab' if offset else 'wb') as fd:
+                    for chunk in response.iter_content(DOWNLOAD_CHUNK_SIZE):
+                        fd.write(chunk)
+                        offset += len(chunk)
+                        received += len(chunk)
+                        if offset > max_size:
+                            raise InvalidFileError("'%s' is too big [>%d bytes]" % (url, max_size))
+                    ## FOR
+                if expected is not None and offset != expected:
+                    raise requests.exceptions.ChunkedEncodingError("Got %d of %d bytes" % (offset, expected))
+                os.remove(meta_path)
+                return offset
+        except InvalidFileError:
+            for p in (path, meta_path):
+                if os.path.exists(p):
+                    os.remove(p)
+            raise
+        except (requests.exceptions.ConnectionError, requests.exceptions.Timeout,
+                requests.exceptions.ChunkedEncodingError) as ex:
+            if attempt >= DOWNLOAD_RETRIES:
+                raise
+            LOG.warning("Download of '%s' was interrupted at %d bytes. Resuming... [%s]", url, offset, ex)
+            sleepFor(2 ** attempt, "download_retry")
+        finally:
+            incrementCounter("bytes_downloaded_total", received, source="pdf")
+    ## FOR
+    raise InvalidFileError("Failed to download '%s'" % url)
+## DEF
+
+def getUrlPath(pdf_url):
+    return getCachePath("urls", hashlib.sha256(pdf_url.encode("utf-8")).hexdigest() + ".json")
+## DEF
+
+## ==============================================
+## getCachedImage
+## ==============================================
+def getCachedImage(pdf_url, width=THUMBNAIL_WIDTH):
+    """Return the path of the thumbnail for the given URL if it is already in the cache (otherwise None)"""
+    url_path = getUrlPath(pdf_url)
+    if not os.path.exists(url_path):
+        return None
+    with open(url_path, 'r') as fd:
+        entry = json.load(fd)
+    img_path = getCachePath("thumbs", f'{entry["sha256"]}-{width}.jpg')
+    return img_path if isValidJpeg(img_path) else None
+## DEF
+
+## ==============================================
+## getPdf
+## ==============================================
+def getPdf(pdf_url):
+    """
+    Return the path to the cached copy of the PDF for the given URL,
+    downloading it if we do not have a valid copy already.
+    """
+    url_path = getUrlPath(pdf_url)
+    if os.path.exists(url_path):
+        with open(url_path, 'r') as fd:
+            entry = json.load(fd)
+        pdf_path = getCachePath("pdf", entry["sha256"] + ".pdf")
+        if isValidPdf(pdf_path, entry["sha256"]):
+            LOG.debug(f"Reusing cached PDF {pdf_path}")
+            touch(url_path)
+            touch(pdf_path)
+            return pdf_path
+        LOG.warning("Cached PDF for '%s' is missing or corrupted. Downloading it again", pdf_url)
+
+    # We don't know the hash of the file until we have all of it, so the
+    # partial download is named after the URL so that we can resume it later
+    part_path = getCachePath("pdf", os.path.basename(url_path)[:-5] + ".part")
+    size = downloadFile(pdf_url, part_path)
+    if not isValidPdf(part_path):
+        os.remove(part_path)
+        raise InvalidFileError("Invalid PDF file for '%s'" % pdf_url)
+    digest = hashFile(part_path)
+    pdf_path = getCachePath("pdf", digest + ".pdf")
+    os.replace(part_path, pdf_path)
+    LOG.debug(f"Downloaded PDF {pdf_path} [{size} bytes]")
+
+    with open(url_path + ".tmp", 'w') as fd:
+        json.dump({"url": pdf_url, "sha256": digest, "size": size}, fd)
+    os.replace(url_path + ".tmp", url_path)
+    return pdf_path
+## DEF
+
+## ==============================================
+## getImage
+## ==============================================
+@timed("thumbnail_seconds")
+def getImage(pdf_url, width=THUMBNAIL_WIDTH):
+    """
+    Create a JPEG thumbnail of the first page of the paper that is the given
+    number of pixels wide. We have pdftoppm render just that page straight to
+    JPEG at the resolution that it needs so that we never have to write out
+    (and then shrink) a full-size image.
+    """
+    LOG.debug("Create thumbnail for '%s'", pdf_url)
+    pdf_path = getPdf(pdf_url)
+
+    # Render the first page of the downloaded PDF
+    digest = os.path.splitext(os.path.basename(pdf_path))[0]
+    img_filename = f'{digest}-{width}'
+    img_path = getCachePath("thumbs", img_filename + ".jpg")
+    if not isValidJpeg(img_path):
+        # Render under a name of our own and then rename it so that other
+        # processes never see (or render on top of) a half-written thumbnail
+        tmp_filename = f'{img_filename}.{os.getpid()}-{threading.get_ident()}.tmp'
+        tmp_path = getCachePath("thumbs", tmp_filename + ".jpg")
+        try:
+            with timer("render_seconds"):
+                convert_from_path(pdf_path, first_page=1, last_page=1, size=(width, None),
+                                  fmt="jpeg", jpegopt={"quality": THUMBNAIL_QUALITY, "optimize": True},
+                                  output_folder=os.path.dirname(tmp_path), output_file=tmp_filename,
+                                  single_file=True, paths_only=True)
+            if not isValidJpeg(tmp_path):
+                raise InvalidFileError("Failed to render thumbnail for '%s'" % pdf_url)
+            os.replace(tmp_path, img_path)
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+        incrementCounter("thumbnails_rendered_total")
+        LOG.debug(f'Conversion successful. Image saved in cache directory: {img_path}')
+        # Only now that we are done with the PDF can it make room for others
+        pruneCache(keep=[ pdf_path, img_path ])
+    else:
+        LOG.debug(f'Reusing existing image: {img_path}')
+        incrementCounter("thumbnail_cache_hits_total")
+        touch(img_path)
+    return img_path
+## DEF
+
+## ==============================================
+## pruneCache
+## ==============================================
+def pruneCache(max_size=CACHE_MAX_SIZE, keep=[ ]):
+    """
+    Remove the least recently used PDFs and thumbnails until the cache is below
+    the given number of bytes. The files in keep and anything that was used in
+    the last CACHE_MIN_AGE seconds (including partial downloads) are left alone.
+    Returns the number of files that were removed.
+    """
+    keep = set(os.path.realpath(path) for path in keep)
+    min_mtime = time.time() - CACHE_MIN_AGE
+    entries = [ ]
+    total = 0
+    for dirpath, dirnames, filenames in os.walk(CACHE_DIR):
+        subdir = os.path.relpath(dirpath, CACHE_DIR)
+        for f in filenames:
+            path = os.path.join(dirpath, f)
+            try:
+                st = os.stat(path)
+            except FileNotFoundError:
+                # Another process got rid of it
+                continue
+            total += st.st_size
+            if subdir in EVICTABLE and st.st_mtime < min_mtime and os.path.realpath(path) not in keep:
+                entries.append((st.st_mtime, st.st_size, path))
+    ## FOR
+
+    removed = 0
+    for mtime, size, path in sorted(entries):
+        if total <= max_size:
+            break
+        LOG.debug("Evicting '%s' from cache [%d bytes]", path, size)
+        try:
+            os.remove(path)
+            removed += 1
+        except FileNotFoundError:
+            pass
+        total -= size
+    ## FOR
+    if total > max_size:
+        LOG.debug("Cache is still %d bytes over the limit because the rest is in use", total - max_size)
+    return removed
+## DEF
+
+## ==============================================
+## verifyCache
+## ==============================================
+def verifyCache():
+    """Remove any cached PDFs or thumbnails that are corrupted. Returns the number removed"""
+    checks = {
+        "pdf":      lambda path: path.endswith((".part", ".part.json")) or (path.endswith(".pdf") and isValidPdf(path, os.path.basename(path)[:-4])),
+        "thumbs":   isValidJpeg,
+    }
+    removed = 0
+    for subdir, check in checks.items():
+        dirpath = os.path.join(CACHE_DIR, subdir)
+        if not os.path.exists(dirpath):
+            continue
+        for f in os.listdir(dirpath):
+            path = os.path.join(dirpath, f)
+            if not check(path):
+                LOG.warning("Removing corrupted cache file '%s'", path)
+                os.remove(path)
+                removed += 1
+        ## FOR
+    ## FOR
+    return removed
+## DEF
+
+## ==============================================
+## getCacheStats
+## ==============================================
+def getCacheStats():
+    stats = { }
+    for subdir in ("urls", "pdf", "thumbs"):
+        dirpath = os.path.join(CACHE_DIR, subdir)
+        files = os.listdir(dirpath) if os.path.exists(dirpath) else [ ]
+        stats[subdir] = (len(files), sum(os.path.getsize(os.path.join(dirpath, f)) for f in files))
+    return stats
+## DEF
+
+## ==============================================
+## encodeImage
+## ==============================================
+def encodeImage(image, quality, scale=1.0):
+    """Encode the image as a JPEG in memory, shrinking it by the given scale first"""
+    if scale < 1.0:
+        width, height = image.size
+        image = image.resize((max(1, int(width * scale)), max(1, int(height * scale))), Image.LANCZOS)
+    output = io.BytesIO()
+    image.save(output, format='JPEG', quality=quality, optimize=True)
+    return output.getvalue()
+## DEF
+
+## ==============================================
+## resizeImage
+## ==============================================
+@timed("resize_seconds")
+def resizeImage(img_path, max_size_kb: int):
+    """
+    Return the bytes of the largest JPEG version of the image that is below the
+    given size. We first binary search for the highest quality that fits at the
+    full size. If even THUMBNAIL_MIN_QUALITY is too big, then we binary search
+    for the largest scale that fits at that quality.
+
+    :param img_path: Path to the image file.
+    :param max_size_kb: Maximum allowed file size in KB.
+    """
+    max_size_bytes = max_size_kb * 1024
+
+    if os.path.getsize(img_path) <= max_size_bytes:
+        with open(img_path, 'rb') as f:
+            return f.read()
+
+    image = Image.open(img_path).convert("RGB")
+    width, height = image.size
+    LOG.debug(f"Compressing Image '{img_path}' // (width={width}, height={height}) // File Size: {os.path.getsize(img_path) / 1024:.2f} KB")
+
+    best = None
+    num_encodes = 0
+    low, high = THUMBNAIL_MIN_QUALITY, THUMBNAIL_QUALITY
+    while low <= high:
+        quality = (low + high) // 2
+        data = encodeImage(image, quality)
+        num_encodes += 1
+        if len(data) <= max_size_bytes:
+            best = (data, quality, 1.0)
+            low = quality + 1
+        else:
+            high = quality - 1
+    ## WHILE
+
+    if best is None:
+        LOG.debug("Image is too big at quality %d. Searching for a smaller scale", THUMBNAIL_MIN_QUALITY)
+        low, high = 0.0, 1.0
+        for i in range(THUMBNAIL_SCALE_STEPS):
+            scale = (low + high) / 2
+            data = encodeImage(image, THUMBNAIL_MIN_QUALITY, scale)
+            num_encodes += 1
+            if len(data) <= max_size_bytes:
+                best = (data, THUMBNAIL_MIN_QUALITY, scale)
+                low = scale
+            else:
+                high = scale
+        ## FOR
+    if best is None:
+        raise Exception("Unable to compress '%s' below %d KB" % (img_path, max_size_kb))
+
+    incrementCounter("image_encodes_total", num_encodes)
+    data, quality, scale = best
+    LOG.debug(f"Final Image '{img_path}' // (width={int(width * scale)}, height={int(height * scale)}, quality={quality}) // File Size: {len(data) / 1024:.2f} KB // Encodes: {num_encodes}")
+    return data
+## DEF